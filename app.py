@@ -1,22 +1,181 @@
-from flask import Flask, render_template, abort, request, jsonify
+from flask import Flask, render_template, abort, request, jsonify, make_response, Response, stream_with_context, g, has_request_context, url_for
 from flask_caching import Cache
 import json
 import requests
 import pandas as pd
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import os
 from datetime import datetime, timedelta
 import pytz
 import time
 import logging
+import threading
+import sqlite3
+import hashlib
+import io
+import pickle
+import re
+import sys
+import random
+import uuid
+import statistics
+import contextvars
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock, the refresh lock uses msvcrt instead
+    fcntl = None
+    import msvcrt
 from azure.identity import DefaultAzureCredential, ManagedIdentityCredential
 
 app = Flask(__name__)
 cache = Cache(app, config={'CACHE_TYPE': 'simple', 'CACHE_DEFAULT_TIMEOUT': 3600})
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(request_id)s - %(message)s')
+
+# Logging filter adding the ID of the request being served ('-' for background threads) to every log record
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = g.get('request_id', '-') if has_request_context() else '-'
+        return True
+
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
+
+# In-process metrics exported in the Prometheus text format on /metrics
+class MetricsRegistry:
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descriptions = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, description, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.descriptions[name] = ('counter', description)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, description, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.descriptions[name] = ('histogram', description)
+            histogram = self.histograms.setdefault(key, {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0})
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    @contextmanager
+    def timer(self, name, description, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, description, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+    # Function to render every metric, plus point-in-time gauges given as {name: (description, value)}
+    def render(self, gauges=None):
+        lines = []
+        with self.lock:
+            for name, (kind, description) in sorted(self.descriptions.items()):
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+                if kind == 'counter':
+                    for (metric, labels), value in sorted(self.counters.items()):
+                        if metric == name:
+                            lines.append(f"{name}{self._labels(labels)} {value}")
+                else:
+                    for (metric, labels), histogram in sorted(self.histograms.items()):
+                        if metric != name:
+                            continue
+                        for bound, count in zip(self.buckets, histogram['buckets']):
+                            lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                        lines.append(f"{name}_sum{self._labels(labels)} {histogram['sum']}")
+                        lines.append(f"{name}_count{self._labels(labels)} {histogram['count']}")
+        for name, (description, value) in sorted((gauges or {}).items()):
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+# Name of the query the current thread is executing, used to label upstream request metrics
+current_query = contextvars.ContextVar('current_query', default='unknown')
+
+# Function to record a cache lookup
+def record_cache_lookup(cache_name, hit):
+    metrics.inc('costs_cache_requests_total', 'Cache lookups by cache and result', cache=cache_name, result='hit' if hit else 'miss')
 
 scope = os.environ['SCOPE']
 reservation_cost = os.getenv('RESERVATION_COST', '0.00')
 FETCH_CONSUMPTION_DATA = os.getenv('FETCH_MACC_DATA', 'false')
+ENABLE_SNAPSHOT_WARMER = os.getenv('ENABLE_SNAPSHOT_WARMER', 'true').lower() == 'true'
+SNAPSHOT_REFRESH_INTERVAL = int(os.getenv('SNAPSHOT_REFRESH_INTERVAL', '3600'))
+SNAPSHOT_RETRY_INTERVAL = int(os.getenv('SNAPSHOT_RETRY_INTERVAL', '300'))
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', os.path.join('cache', 'snapshot.pickle'))
+SNAPSHOT_LOCK_PATH = os.getenv('SNAPSHOT_LOCK_PATH', os.path.join('cache', 'snapshot.lock'))
+SNAPSHOT_POLL_INTERVAL = int(os.getenv('SNAPSHOT_POLL_INTERVAL', '15'))
+AZURE_MANAGEMENT_ENDPOINT = os.getenv('AZURE_MANAGEMENT_ENDPOINT', 'https://management.azure.com').rstrip('/')
+AZURE_MAX_CONCURRENT_REQUESTS = int(os.getenv('AZURE_MAX_CONCURRENT_REQUESTS', '4'))
+AZURE_MAX_RETRIES = int(os.getenv('AZURE_MAX_RETRIES', '8'))
+AZURE_BACKOFF_BASE = float(os.getenv('AZURE_BACKOFF_BASE', '2'))
+AZURE_BACKOFF_MAX = float(os.getenv('AZURE_BACKOFF_MAX', '120'))
+AZURE_QUOTA_LOW_WATERMARK = int(os.getenv('AZURE_QUOTA_LOW_WATERMARK', '5'))
+AZURE_QUOTA_PAUSE = float(os.getenv('AZURE_QUOTA_PAUSE', '10'))
+AZURE_CONNECT_TIMEOUT = float(os.getenv('AZURE_CONNECT_TIMEOUT', '10'))
+AZURE_READ_TIMEOUT = float(os.getenv('AZURE_READ_TIMEOUT', '120'))
+AZURE_TOKEN_REFRESH_MARGIN = int(os.getenv('AZURE_TOKEN_REFRESH_MARGIN', '300'))
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '8'))
+MAX_QUERY_ROWS = int(os.getenv('MAX_QUERY_ROWS', '1000000'))
+RESULT_CACHE_BACKEND = os.getenv('RESULT_CACHE_BACKEND', 'sqlite').lower()
+RESULT_CACHE_PATH = os.getenv('RESULT_CACHE_PATH', os.path.join('cache', 'results.sqlite'))
+RESULT_CACHE_URL = os.getenv('RESULT_CACHE_URL', 'redis://localhost:6379/0')
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', '3600'))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '500'))
+COST_STORE_ENABLED = os.getenv('COST_STORE_ENABLED', 'false').lower() == 'true'
+COST_STORE_PATH = os.getenv('COST_STORE_PATH', os.path.join('cache', 'costs.sqlite'))
+COST_STORE_RESTATEMENT_DAYS = int(os.getenv('COST_STORE_RESTATEMENT_DAYS', '3'))
+STREAM_ROW_THRESHOLD = int(os.getenv('STREAM_ROW_THRESHOLD', '5000'))
+STREAM_CHUNK_ROWS = int(os.getenv('STREAM_CHUNK_ROWS', '1000'))
+REPORT_PAGE_SIZE = int(os.getenv('REPORT_PAGE_SIZE', '50'))
+REPORT_MAX_PAGE_SIZE = int(os.getenv('REPORT_MAX_PAGE_SIZE', '1000'))
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '50000'))
+# Scopes (billing accounts, subscriptions, management groups) combined by the consolidated views, SCOPE by default
+scopes = [value.strip().strip('/') for value in os.getenv('SCOPES', scope).split(',') if value.strip()]
+SCOPE_MAX_CONCURRENT_QUERIES = int(os.getenv('SCOPE_MAX_CONCURRENT_QUERIES', '2'))
+CONSOLIDATION_MAX_CONCURRENCY = int(os.getenv('CONSOLIDATION_MAX_CONCURRENCY', '16'))
+JOB_MAX_WORKERS = int(os.getenv('JOB_MAX_WORKERS', '8'))
+JOB_INLINE_WAIT = float(os.getenv('JOB_INLINE_WAIT', '0.25'))
+JOB_MAX_WAIT = float(os.getenv('JOB_MAX_WAIT', '1'))
+JOB_POLL_INTERVAL = int(os.getenv('JOB_POLL_INTERVAL', '1'))
+JOB_RETENTION = int(os.getenv('JOB_RETENTION', '300'))
+ANOMALY_WINDOW_DAYS = int(os.getenv('ANOMALY_WINDOW_DAYS', '14'))
+ANOMALY_THRESHOLD = float(os.getenv('ANOMALY_THRESHOLD', '3.5'))
+ANOMALY_MIN_INCREASE = float(os.getenv('ANOMALY_MIN_INCREASE', '10'))
+DAILY_HISTORY_DAYS = int(os.getenv('DAILY_HISTORY_DAYS', '120'))
+ANOMALY_LOOKBACK_DAYS = int(os.getenv('ANOMALY_LOOKBACK_DAYS', '7'))
+LOCAL_FORECAST_ENABLED = os.getenv('LOCAL_FORECAST_ENABLED', 'true').lower() == 'true'
+FORECAST_FIT_DAYS = int(os.getenv('FORECAST_FIT_DAYS', '28'))
+FORECAST_MIN_DAYS = int(os.getenv('FORECAST_MIN_DAYS', '7'))
+FORECAST_INTERVAL = float(os.getenv('FORECAST_INTERVAL', '0.95'))
+QUERY_BODY_PATH = os.getenv('QUERY_BODY_PATH', 'body')
+QUERY_SPEC_PATH = os.getenv('QUERY_SPEC_PATH', 'queries.json')
+QUERY_RELOAD_INTERVAL = float(os.getenv('QUERY_RELOAD_INTERVAL', '5'))
 
 # Check if MANAGED_IDENTITY_CLIENT_ID is set and not empty
 use_managed_identity = bool(os.getenv('MANAGED_IDENTITY_CLIENT_ID'))
@@ -29,16 +188,272 @@ else:
     # Use default credentials
     credential = DefaultAzureCredential()
 
-# Function to format UsageDate column if it exists
-def format_usage_date_column(df):
+# Shared HTTP client with a pooled keep-alive session and a cached access token
+class AzureClient:
+    def __init__(self, credential, pool_size, timeout, token_refresh_margin):
+        self.credential = credential
+        self.timeout = timeout
+        self.token_refresh_margin = token_refresh_margin
+        self.token = None
+        self.token_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Content-Type': 'application/json',
+            'x-ms-command-name': 'CostAnalysis',
+            'ClientType': 'sxt-costs-app'
+        })
+
+    # Only ask the credential for a new token when the cached one is close to expiring
+    def get_access_token(self):
+        with self.token_lock:
+            if self.token is None or self.token.expires_on - self.token_refresh_margin <= time.time():
+                record_cache_lookup('token', False)
+                with metrics.timer('costs_token_acquisition_seconds', 'Time spent acquiring Azure access tokens'):
+                    self.token = self.credential.get_token('https://management.azure.com/.default')
+            else:
+                record_cache_lookup('token', True)
+            return self.token.token
+
+    def request(self, method, url, payload=None):
+        headers = {'Authorization': f'Bearer {self.get_access_token()}'}
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, headers=headers, json=payload, timeout=self.timeout)
+        except requests.RequestException:
+            metrics.observe('costs_upstream_request_seconds', 'Latency of Azure API calls by query and status',
+                            time.perf_counter() - started, query=current_query.get(), status='error')
+            raise
+        elapsed = time.perf_counter() - started
+        metrics.observe('costs_upstream_request_seconds', 'Latency of Azure API calls by query and status',
+                        elapsed, query=current_query.get(), status=response.status_code)
+        logging.info(json.dumps({'event': 'upstream_request', 'query': current_query.get(), 'method': method,
+                                 'status': response.status_code, 'duration_ms': round(elapsed * 1000, 1)}))
+        if response.status_code == 401:
+            # Token was revoked or rotated early, drop it so the next attempt fetches a new one
+            with self.token_lock:
+                self.token = None
+        return response
+
+azure_client = AzureClient(credential, AZURE_MAX_CONCURRENT_REQUESTS, (AZURE_CONNECT_TIMEOUT, AZURE_READ_TIMEOUT), AZURE_TOKEN_REFRESH_MARGIN)
+
+# Scheduler that every outbound Azure call goes through so concurrent requests share one rate-limit budget
+class AzureRequestScheduler:
+    def __init__(self, max_concurrent, max_retries, backoff_base, backoff_max,
+                 quota_low_watermark=AZURE_QUOTA_LOW_WATERMARK, quota_pause=AZURE_QUOTA_PAUSE):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.quota_low_watermark = quota_low_watermark
+        self.quota_pause = quota_pause
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.blocked_until = 0.0
+        self.queue_depth = 0
+        self.stats = {'requests': 0, 'deduplicated': 0, 'throttled': 0, 'retries': 0, 'paced': 0,
+                      'total_wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+
+    # Identical queries (same method, URL incl. scope, and payload) share a single upstream call
+    def request(self, method, url, payload=None):
+        key = (method, url, json.dumps(payload, sort_keys=True))
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[key] = future
+            else:
+                self.stats['deduplicated'] += 1
+
+        if not owner:
+            metrics.inc('costs_upstream_deduplicated_total', 'Azure API calls answered by an identical in-flight call', query=current_query.get())
+            return future.result()
+
+        try:
+            response = self._execute(method, url, payload)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def _execute(self, method, url, payload):
+        attempt = 0
+        while True:
+            response = None
+            error = None
+            self._wait_for_slot()
+            try:
+                response = azure_client.request(method, url, payload)
+            except requests.RequestException as e:
+                error = e
+            finally:
+                self.slots.release()
+            if response is not None:
+                self._pace(response.headers)
+
+            retryable = error is not None or response.status_code == 429 or response.status_code >= 500
+            if not retryable or attempt >= self.max_retries:
+                if error is not None:
+                    raise error
+                return response
+
+            delay = self._backoff(attempt)
+            if response is not None:
+                retry_after = self._retry_after(response.headers)
+                if response.status_code == 429:
+                    metrics.inc('costs_upstream_throttled_total', 'Azure API calls answered with HTTP 429', query=current_query.get())
+                    with self.lock:
+                        self.stats['throttled'] += 1
+                    # Throttling applies to the whole client, so pause every queued call
+                    delay = max(delay, retry_after or 0)
+                    with self.lock:
+                        self.blocked_until = max(self.blocked_until, time.time() + delay)
+                elif retry_after:
+                    delay = max(delay, retry_after)
+
+            attempt += 1
+            metrics.inc('costs_upstream_retries_total', 'Retried Azure API calls', query=current_query.get())
+            with self.lock:
+                self.stats['retries'] += 1
+            logging.warning(f"Azure request to {url} failed ({error or response.status_code}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+    # Wait until the global throttle window has passed and a concurrency slot is free
+    def _wait_for_slot(self):
+        started = time.time()
+        with self.lock:
+            self.queue_depth += 1
+        try:
+            while True:
+                with self.lock:
+                    remaining = self.blocked_until - time.time()
+                if remaining > 0:
+                    time.sleep(remaining)
+                    continue
+                self.slots.acquire()
+                with self.lock:
+                    remaining = self.blocked_until - time.time()
+                if remaining <= 0:
+                    break
+                # A throttle started while waiting for the slot, give it back and wait again
+                self.slots.release()
+        finally:
+            waited = time.time() - started
+            metrics.observe('costs_scheduler_wait_seconds', 'Time Azure API calls waited for the request scheduler', waited)
+            with self.lock:
+                self.queue_depth -= 1
+                self.stats['requests'] += 1
+                self.stats['total_wait_seconds'] += waited
+                self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], waited)
+
+    # Slow every queued call down as the remaining quota reported by the x-ms-ratelimit-*-remaining headers runs low, so
+    # the API is not driven into throttling: below quota_low_watermark calls are spaced up to quota_pause seconds apart
+    def _pace(self, headers):
+        remaining = self._quota_remaining(headers)
+        if remaining is None or remaining >= self.quota_low_watermark:
+            return
+        delay = self.quota_pause * (1 - max(remaining, 0) / self.quota_low_watermark)
+        metrics.inc('costs_upstream_paced_total', 'Azure API calls followed by a pause because the remaining quota ran low', query=current_query.get())
+        with self.lock:
+            self.stats['paced'] += 1
+            self.blocked_until = max(self.blocked_until, time.time() + delay)
+        logging.info(f"Azure quota low ({remaining:g} remaining), pausing calls for {delay:.1f}s")
+
+    # Lowest remaining quota of the x-ms-ratelimit-*-remaining* headers, which carry either a number or key=number pairs
+    # (e.g. QueryResource=10;QueryTenant=200)
+    @staticmethod
+    def _quota_remaining(headers):
+        values = []
+        for name, value in headers.items():
+            name = name.lower()
+            if name.startswith('x-ms-ratelimit-') and 'remaining' in name:
+                for part in re.split(r'[;,]', str(value)):
+                    try:
+                        values.append(float(part.rpartition('=')[2]))
+                    except ValueError:
+                        continue
+        return min(values) if values else None
+
+    # Exponential backoff with full jitter, bounded by backoff_max
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    # Seconds to wait according to Retry-After and the x-ms-ratelimit-*-retry-after headers
+    @staticmethod
+    def _retry_after(headers):
+        values = []
+        for name, value in headers.items():
+            name = name.lower()
+            if name == 'retry-after' or (name.startswith('x-ms-ratelimit-') and name.endswith('retry-after')):
+                try:
+                    values.append(float(value))
+                    continue
+                except (TypeError, ValueError):
+                    pass
+                # Retry-After may also be an HTTP date
+                try:
+                    retry_at = parsedate_to_datetime(value)
+                except (TypeError, ValueError):
+                    continue
+                if retry_at.tzinfo is None:
+                    retry_at = retry_at.replace(tzinfo=pytz.utc)
+                values.append(max(0.0, (retry_at - datetime.now(pytz.utc)).total_seconds()))
+        return max(values) if values else None
+
+    def status(self):
+        with self.lock:
+            stats = dict(self.stats)
+            requests_made = stats['requests']
+            return {
+                'queue_depth': self.queue_depth,
+                'in_flight': len(self.in_flight),
+                'throttled_for_seconds': max(0.0, round(self.blocked_until - time.time(), 1)),
+                'average_wait_seconds': round(stats['total_wait_seconds'] / requests_made, 3) if requests_made else 0.0,
+                **stats
+            }
+
+scheduler = AzureRequestScheduler(AZURE_MAX_CONCURRENT_REQUESTS, AZURE_MAX_RETRIES, AZURE_BACKOFF_BASE, AZURE_BACKOFF_MAX)
+
+# Format usage dates are displayed in (e.g. October 01, 2024)
+REPORT_DATE_FORMAT = '%B %d, %Y'
+
+# Function to convert the yyyymmdd UsageDate numbers to datetime64, dates are only formatted when a report is displayed
+def parse_usage_date_column(df):
     if 'UsageDate' in df.columns:
-        # Convert UsageDate to datetime format
-        df['UsageDate'] = pd.to_datetime(df['UsageDate'], format='%Y%m%d')
+        # Reports only contain a few distinct dates, so convert each one once
+        codes, uniques = pd.factorize(df['UsageDate'])
+        parsed = pd.to_datetime(pd.Series(uniques), format='%Y%m%d').to_numpy()
+        df['UsageDate'] = np.where(codes >= 0, parsed[codes] if len(parsed) else np.datetime64('NaT'), np.datetime64('NaT'))
+    return df
 
-        # Convert UsageDate to the desired format (year-month-date)
-        df['UsageDate'] = df['UsageDate'].dt.strftime('%B %d, %Y')
+# Function to store text columns as categoricals, each distinct dimension value is then kept once instead of once per row
+def categorize_dimension_columns(df):
+    for col in df.select_dtypes(include=['object']).columns:
+        df[col] = df[col].astype('category')
     return df
 
+# Function to evaluate a text check once per distinct value of a column (as displayed) and map the result back to every row
+def distinct_value_mask(series, check):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes, uniques = series.cat.codes.to_numpy(), pd.Series(series.cat.categories)
+    else:
+        codes, uniques = pd.factorize(series)
+        uniques = pd.Series(uniques)
+    if not len(uniques):
+        return np.zeros(len(series), dtype=bool)
+    text = uniques.dt.strftime(REPORT_DATE_FORMAT) if pd.api.types.is_datetime64_any_dtype(uniques) else uniques.astype(str)
+    matches = check(text).to_numpy(dtype=bool)
+    # Missing values have code -1 and never match
+    return np.where(codes >= 0, matches[codes], False)
+
 # Function to removed TagKey column if it exists
 def removed_key_column(df):
     # Check if 'TagKey' is in the columns
@@ -63,22 +478,48 @@ def replace_column_names_with_keyword(df, keyword, new_name):
 def remove_rows_with_dash_and_number(df):
     # Define regex pattern to match '-' followed by a number
     pattern = r'-\d+'
-    # Loop through each cell in the DataFrame and check if it matches the pattern
-    mask = df.apply(lambda x: x.astype(str).str.contains(pattern, na=False)).any(axis=1)
+    mask = pd.Series(False, index=df.index)
+    for col in df.columns:
+        if pd.api.types.is_numeric_dtype(df[col]):
+            # A negative number is the only way a numeric cell renders as '-' followed by a number
+            mask |= df[col] < 0
+        else:
+            # Dimension values repeat a lot, so match each distinct value once
+            mask |= distinct_value_mask(df[col], lambda values: values.str.contains(pattern, na=False))
     # Filter out rows where any cell matches the pattern
     return df[~mask]
 
 def remove_rows_with_zero(df):
-    # Iterate over columns and check if any column has $0.00
-    rows_to_drop = df[df.apply(lambda row: any(val.strip() == '$0.00' for val in row.values if isinstance(val, str)), axis=1)].index
+    # Check if any numeric column would display as $0.00
+    mask = pd.Series(False, index=df.index)
+    for col in df.select_dtypes(include=['number']).columns:
+        mask |= (df[col] >= 0) & (df[col] < 0.005)
     # Drop rows with any column containing $0.00
-    df_filtered = df.drop(index=rows_to_drop)
-    return df_filtered
+    return df[~mask]
 
 def remove_rows_with_empty_cells(df):
-    # Iterate over rows and check if any row has an empty cell
-    rows_to_drop = df[df.apply(lambda row: any(pd.isnull(val) or (isinstance(val, str) and val.strip() == '') for val in row.values), axis=1)].index
-    return df.drop(rows_to_drop)
+    # Check if any row has a missing or blank cell
+    mask = df.isna().any(axis=1)
+    for col in df.select_dtypes(include=['object', 'category']).columns:
+        mask |= distinct_value_mask(df[col], lambda values: values.str.strip() == '')
+    return df[~mask]
+
+# Function to format usage dates as text (e.g. October 01, 2024), missing dates become empty cells
+def format_date_columns(df):
+    df = df.copy()
+    for col in df.select_dtypes(include=['datetime']).columns:
+        codes, uniques = pd.factorize(df[col])
+        # Code -1 (missing) picks the trailing empty label
+        labels = np.append(pd.DatetimeIndex(uniques).strftime(REPORT_DATE_FORMAT).to_numpy(dtype=object), '')
+        df[col] = labels[codes]
+    return df
+
+# Function to format numeric columns as currency and dates as text, applied only when a report is rendered
+def format_report_columns(df):
+    df = format_date_columns(df)
+    for col in df.select_dtypes(include=['number']).columns:
+        df[col] = df[col].map('${:,.2f}'.format, na_action='ignore').fillna('')
+    return df
 
     # Function to replace column names containing keyword with new_name
 def replace_column_names(df, keyword, new_name):
@@ -87,80 +528,254 @@ def replace_column_names(df, keyword, new_name):
     return df.rename(columns=rename_dict)
 
 def fetch_consumption_data():
-    url = f"https://management.azure.com/{scope}/providers/Microsoft.Consumption/lots?api-version=2021-05-01&$filter=source%20eq%20%27ConsumptionCommitment%27"
-
-    token = credential.get_token('https://management.azure.com/.default')
-    access_token = token.token
-
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-        'x-ms-command-name': 'CostAnalysis',
-        'ClientType': 'sxt-costs-app'
-    }
+    url = f"{AZURE_MANAGEMENT_ENDPOINT}/{scope}/providers/Microsoft.Consumption/lots?api-version=2021-05-01&$filter=source%20eq%20%27ConsumptionCommitment%27"
 
     try:
-        response = requests.get(url, headers=headers)
+        current_query.set('consumption')
+        response = scheduler.request('GET', url)
         response.raise_for_status()
         data = response.json()
         return data
     except requests.RequestException as e:
-        print(f"Failed to fetch consumption data: {e}")
+        logging.warning(f"Failed to fetch consumption data: {e}")
         return None
 
 # Function to make JSON POST request and return DataFrame
-def make_post_request(scope, payload, to=None):
-
-    token = credential.get_token('https://management.azure.com/.default')
-    access_token = token.token
-
+def make_post_request(scope, payload):
     # Prepare URL
-    url = f"https://management.azure.com/{scope}/providers/Microsoft.CostManagement/query?api-version=2023-11-01"
-    
-    # Prepare headers
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-        'x-ms-command-name': 'CostAnalysis',
-        'ClientType': 'sxt-costs-app'
-    }
-
-    # Add 'to' parameter to payload if provided
-    if to:
-        payload['timeframe'] = {'to': to}
+    url = f"{AZURE_MANAGEMENT_ENDPOINT}/{scope}/providers/Microsoft.CostManagement/query?api-version=2023-11-01"
 
-    # Make a request to the Azure Cost Management API
-    response = requests.post(url, headers=headers, json=payload)
-    response_json = response.json()
-
-    # Process the response data and return as DataFrame
-    if response.status_code == 200:
-        # Extracting data from the response JSON
-        columns = [col['name'] for col in response_json['properties']['columns']]
-        rows = response_json['properties']['rows']
+    # Make requests to the Azure Cost Management API and process each page as it arrives
+    try:
+        return build_result_dataframe(fetch_result_frame(url, payload))
+    except requests.RequestException:
+        logging.warning(f"Error: Unable to retrieve data for Scope: {scope}")
+        return None
 
-        # Convert to DataFrame
-        df = pd.DataFrame(rows, columns=columns)
+# Function to yield every page of a query or forecast result by following properties.nextLink
+def iter_result_pages(url, payload, max_rows=MAX_QUERY_ROWS):
+    row_count = 0
+    while url:
+        response = scheduler.request('POST', url, payload)
+        response.raise_for_status()  # This will raise an error for non-2xx responses
+        page = response.json()
+        properties = page['properties']
+
+        # Stop paging once the row cap is reached
+        remaining = max_rows - row_count
+        if len(properties['rows']) > remaining or (len(properties['rows']) == remaining and properties.get('nextLink')):
+            logging.warning(f"Result of {url} truncated at {max_rows} rows")
+            properties['rows'] = properties['rows'][:remaining]
+            properties['nextLink'] = None
+            properties['truncated'] = True
+
+        row_count += len(properties['rows'])
+        url = properties.get('nextLink')
+        yield page
+
+# Result cache on SQLite so every gunicorn worker and restart shares the same query results
+class SQLiteResultCache:
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS result_frames (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute('SELECT value FROM result_frames WHERE key = ? AND expires_at > ?', (key, now)).fetchone()
+            if row is not None:
+                connection.execute('UPDATE result_frames SET last_access = ? WHERE key = ?', (now, key))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO result_frames (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)',
+                               (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + ttl, now))
+            # Drop expired entries, then the least recently used ones above the size bound
+            connection.execute('DELETE FROM result_frames WHERE expires_at <= ?', (now,))
+            connection.execute('DELETE FROM result_frames WHERE key NOT IN (SELECT key FROM result_frames ORDER BY last_access DESC LIMIT ?)',
+                               (self.max_entries,))
+
+    def status(self):
+        with self._connect() as connection:
+            entries = connection.execute('SELECT COUNT(*) FROM result_frames').fetchone()[0]
+        return {'backend': 'sqlite', 'entries': entries, 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses}
+
+# Result cache on Redis (or any client with the same get/set/zadd/zrange/zrem/zcard/delete interface)
+class RedisResultCache:
+    def __init__(self, client, max_entries, prefix='costs:frame:'):
+        self.client = client
+        self.max_entries = max_entries
+        self.prefix = prefix
+        self.index = prefix + 'lru'
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            self.client.zrem(self.index, key)
+            return None
+        self.hits += 1
+        self.client.zadd(self.index, {key: time.time()})
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex=max(1, int(ttl)))
+        self.client.zadd(self.index, {key: time.time()})
+        # Evict the least recently used keys above the size bound
+        excess = self.client.zcard(self.index) - self.max_entries
+        if excess > 0:
+            for evicted in self.client.zrange(self.index, 0, excess - 1):
+                evicted = evicted.decode() if isinstance(evicted, bytes) else evicted
+                self.client.delete(self.prefix + evicted)
+                self.client.zrem(self.index, evicted)
+
+    def status(self):
+        return {'backend': 'redis', 'entries': self.client.zcard(self.index), 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses}
+
+# Result cache that never stores anything, used when RESULT_CACHE_BACKEND is none
+class NullResultCache:
+    def get(self, key):
+        return None
 
-        # Remove Currency Column
-        if 'Currency' in df.columns:
-            df.drop(columns=['Currency'], inplace=True)
+    def set(self, key, value, ttl):
+        pass
+
+    def status(self):
+        return {'backend': 'none'}
+
+# Function to create the configured result cache backend
+def create_result_cache():
+    if RESULT_CACHE_BACKEND == 'redis':
+        # Optional dependency, only needed when the Redis backend is selected
+        import redis
+        return RedisResultCache(redis.Redis.from_url(RESULT_CACHE_URL), RESULT_CACHE_MAX_ENTRIES)
+    if RESULT_CACHE_BACKEND == 'sqlite':
+        return SQLiteResultCache(RESULT_CACHE_PATH, RESULT_CACHE_MAX_ENTRIES)
+    return NullResultCache()
+
+result_cache = create_result_cache()
+
+# Function to build the cache key from the URL (scope and endpoint), the dates the payload covers and the payload with
+# its time window normalized to days. Relative timeframes (MonthToDate) have no dates in the payload, so the resolved
+# window keeps results of one day (or month) from being served on the next
+def result_cache_key(url, payload):
+    normalized = re.sub(r'(\d{4}-\d{2}-\d{2})T[0-9:.]+Z', r'\1', json.dumps(payload, sort_keys=True))
+    window = payload_window(payload)
+    return hashlib.sha256(f"{url}|{window}|{normalized}".encode()).hexdigest()
+
+# Function to pick the cache lifetime of a result from its timeframe
+def result_cache_ttl(payload):
+    now = datetime.now()
+    seconds_until_midnight = (datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds()
+
+    # Closed periods (last month, yesterday) do not change until the day rolls over
+    timeframe = payload.get('timeframe')
+    if timeframe == 'TheLastBillingMonth':
+        return seconds_until_midnight
+    period_end = payload.get('timePeriod', {}).get('to', '')
+    if timeframe == 'Custom' and period_end and period_end[:10] < now.strftime('%Y-%m-%d'):
+        return seconds_until_midnight
+
+    # Open periods (month to date, year to date, forecast) are refreshed more often
+    return RESULT_CACHE_TTL
+
+# Function to return a complete query or forecast response with all rows, from the result cache when possible
+def fetch_result(url, payload, use_cache=True):
+    return result_response(fetch_result_frame(url, payload, use_cache))
+
+# Function to convert the rows of one result page into a DataFrame, text columns stored as categoricals
+def result_page_frame(page):
+    columns = [col['name'] for col in page['properties']['columns']]
+    return categorize_dimension_columns(pd.DataFrame(page['properties']['rows'], columns=columns))
+
+# Function to collect result pages into a result whose rows are one compact DataFrame, converted page by page so the
+# raw rows of only one page are held at a time
+def result_frame_from_pages(pages):
+    columns, frames, truncated = None, [], False
+    for page in pages:
+        columns = page['properties']['columns']
+        truncated = truncated or bool(page['properties'].get('truncated'))
+        frames.append(result_page_frame(page))
+    if len(frames) == 1:
+        frame = frames[0]
+    else:
+        # Pages with different dimension values concatenate to plain strings, so categorize again
+        frame = categorize_dimension_columns(pd.concat(frames, ignore_index=True))
+    return {'columns': columns, 'frame': frame, 'truncated': truncated}
+
+# Function to return a query result as a compact DataFrame, reading a cached result when there is one and use_cache is set
+# (use_cache=False always queries Azure and replaces the cached result). The compact result itself is cached, so a write
+# costs about its frame size; store_result=False skips it for results only the caller reads
+def fetch_result_frame(url, payload, use_cache=True, store_result=True):
+    key = result_cache_key(url, payload)
+    result = result_cache.get(key) if use_cache else None
+    if use_cache:
+        record_cache_lookup('result', result is not None)
+    if result is None:
+        result = result_frame_from_pages(iter_result_pages(url, payload))
+        if store_result:
+            result_cache.set(key, result, result_cache_ttl(payload))
+    return result
+
+# Function to convert a result back to the Cost Management response shape served by the raw JSON API
+def result_response(result):
+    properties = {'columns': result['columns'], 'rows': dataframe_rows(result['frame']), 'nextLink': None}
+    if result['truncated']:
+        properties['truncated'] = True
+    return {'properties': properties}
+
+# Function to convert a result (rows already in a DataFrame) into a cleaned DataFrame
+def build_result_dataframe(result):
+    return clean_report_dataframe(result['frame'])
+
+# Function to time one cleaning step of the report DataFrames
+def dataframe_step_timer(step):
+    return metrics.timer('costs_dataframe_seconds', 'Time spent in report DataFrame processing steps', step=step)
+
+# Function to clean a raw result frame into a report frame, display_filters=False keeps every row (negative costs and
+# names matching the dash filter) for calculations that must add up to the grand totals
+def clean_report_dataframe(df, display_filters=True):
+    with dataframe_step_timer('columns'):
+        # Remove Currency Column, the raw frame itself is left untouched
+        df = df.drop(columns=['Currency'], errors='ignore')
 
         # Move PreTaxCost Column to the end
         if 'PreTaxCost' in df.columns:
             df = df[[col for col in df.columns if col != 'PreTaxCost'] + ['PreTaxCost']]
 
-        # Format Numbers
+        # Keep costs numeric, they are only formatted when the report is rendered (CostStatus of forecasts is text)
         for col in df.columns:
-            if 'Cost' in col:
-                df[col] = df[col].apply(lambda x: '${:,.2f}'.format(float(x)))
+            if 'Cost' in col and col != 'CostStatus':
+                df[col] = df[col].astype(float)
 
-        # Remove rows containing '-' followed by a number
-        df = format_usage_date_column(df)
+    # Keep usage dates as datetime64, they are only formatted when the report is rendered
+    with dataframe_step_timer('date_parsing'):
+        df = parse_usage_date_column(df)
 
-         # Remove rows containing '-' followed by a number
-        df = remove_rows_with_dash_and_number(df)
+    # Remove rows containing '-' followed by a number
+    if display_filters:
+        with dataframe_step_timer('dash_filter'):
+            df = remove_rows_with_dash_and_number(df)
 
+    with dataframe_step_timer('rename'):
         # Remove TagKey column
         df = removed_key_column(df)
 
@@ -178,83 +793,82 @@ def make_post_request(scope, payload, to=None):
 
         df = replace_column_names_with_keyword(df, 'MeterCategory', 'Category:')
 
-        return df
-    else:
-        print(f"Error: Unable to retrieve data for Scope: {scope}")
-        return None
+    with dataframe_step_timer('categorize'):
+        return categorize_dimension_columns(df)
     
 # Function to make JSON POST request and return DataFrame
-def make_post_request_api(scope, payload, to=None):
+def make_post_request_api(scope, payload, use_cache=True):
     try:
-        token = credential.get_token('https://management.azure.com/.default')
-        access_token = token.token
-
         # Prepare URL
-        url = f"https://management.azure.com/{scope}/providers/Microsoft.CostManagement/query?api-version=2023-11-01"
-    
-        # Prepare headers
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json',
-            'x-ms-command-name': 'CostAnalysis',
-            'ClientType': 'sxt-costs-app'
-        }
-
-        # Add 'to' parameter to payload if provided
-        if to:
-            payload['timeframe'] = {'to': to}
+        url = f"{AZURE_MANAGEMENT_ENDPOINT}/{scope}/providers/Microsoft.CostManagement/query?api-version=2023-11-01"
 
-        # Make a request to the Azure Cost Management API
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()  # This will raise an error for non-2xx responses
-        
-        # Process the response data and return as JSON
-        if response.ok:
-            return response.json(), None, response.status_code
-        else:
-            # Extract error message from response
-            error_message = response.json().get('error', {}).get('message', 'Unknown error')
-            return None, error_message, response.status_code
+        # Make requests to the Azure Cost Management API, following nextLink unless the result is cached
+        return fetch_result(url, payload, use_cache), None, 200
     except requests.RequestException as e:
         # Handle exceptions that occur during the API request
         return None, str(e), 500
     
-    # Function to make JSON POST request and return DataFrame
-def make_post_request_forecast_api(scope, payload, to_time_f, from_time_f):
+# Function to make JSON POST request to the forecast endpoint, the payload comes from the query registry with the
+# current month as its time period
+def make_post_request_forecast_api(scope, payload, use_cache=True):
     try:
-        token = credential.get_token('https://management.azure.com/.default')
-        access_token = token.token
-
         # Prepare URL
-        forecast = f"https://management.azure.com/{scope}/providers/Microsoft.CostManagement/forecast?api-version=2023-11-01"
-    
-        # Prepare headers
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json',
-            'x-ms-command-name': 'CostAnalysis',
-            'ClientType': 'sxt-costs-app'
-        }
-
-        payload['timeframe'] = {'to': to_time_f}
-        
-        payload['timeframe'] = {'from': from_time_f}
+        forecast = f"{AZURE_MANAGEMENT_ENDPOINT}/{scope}/providers/Microsoft.CostManagement/forecast?api-version=2023-11-01"
 
-        # Make a request to the Azure Cost Management API
-        response = requests.post(forecast, headers=headers, json=payload)
-        response.raise_for_status()  # This will raise an error for non-2xx responses
-        
-        # Process the response data and return as JSON
-        if response.ok:
-            return response.json(), None, response.status_code
-        else:
-            # Extract error message from response
-            error_message = response.json().get('error', {}).get('message', 'Unknown error')
-            return None, error_message, response.status_code
+        # Make requests to the Azure Cost Management API, following nextLink unless the result is cached
+        return fetch_result(forecast, payload, use_cache), None, 200
     except requests.RequestException as e:
         # Handle exceptions that occur during the API request
         return None, str(e), 500
     
+# Function to calculate the start and end of the current month
+def get_month_window(current_time):
+    # Calculate the start of the month
+    start_of_month = current_time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    from_time = start_of_month.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    # Calculate the end of the month by finding the start of the next month, then subtracting a microsecond
+    next_month = start_of_month.replace(month=start_of_month.month % 12 + 1)
+    if start_of_month.month == 12:  # Handle December to January transition
+        next_month = next_month.replace(year=start_of_month.year + 1)
+    end_of_month = next_month - timedelta(microseconds=1)
+    to_time = end_of_month.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'  # Truncate microseconds to 3 places
+    return from_time, to_time
+
+QUERY_AGGREGATION = {'totalCost': {'name': 'PreTaxCost', 'function': 'Sum'}}
+QUERY_TIMEFRAMES = ('MonthToDate', 'TheLastBillingMonth', 'Custom')
+
+# Report periods (the prefix of every query name) and the query each period generates for a dimension of the compact spec
+QUERY_PERIODS = {
+    'daily': {'type': 'Usage', 'timeframe': 'MonthToDate', 'dataset': {'granularity': 'Daily', 'aggregation': QUERY_AGGREGATION}},
+    'yesterday': {'type': 'Usage', 'timeframe': 'Custom', 'timePeriod': {'from': '', 'to': ''},
+                  'dataset': {'granularity': 'None', 'aggregation': QUERY_AGGREGATION}},
+    'mtd': {'type': 'Usage', 'timeframe': 'MonthToDate', 'dataset': {'granularity': 'None', 'aggregation': QUERY_AGGREGATION}},
+    'last-month': {'type': 'Usage', 'timeframe': 'TheLastBillingMonth', 'dataset': {'granularity': 'None', 'aggregation': QUERY_AGGREGATION}},
+    'ytd': {'type': 'Usage', 'timeframe': 'Custom', 'timePeriod': {'from': '', 'to': ''},
+            'dataset': {'granularity': 'None', 'aggregation': QUERY_AGGREGATION}},
+    'forecast': None
+}
+
+# Function to compute the rolling time period of a report period, None when the query keeps its own timeframe
+def query_time_period(period, time_period, current_time):
+    if period == 'ytd':
+        # Year to date runs from the configured start, or the start of the current year, until now
+        start_of_year = current_time.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+        return {'from': time_period.get('from') or start_of_year.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'to': current_time.strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+    # Calculate the start and end time for yesterday
+    if period == 'yesterday':
+        start_of_yesterday = (current_time - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        end_of_yesterday = (current_time - timedelta(days=1)).replace(hour=23, minute=59, second=59, microsecond=999999)
+        return {'from': start_of_yesterday.strftime('%Y-%m-%dT%H:%M:%SZ'), 'to': end_of_yesterday.strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+    if period == 'forecast':
+        from_time, to_time = get_month_window(current_time)
+        return {'from': from_time, 'to': to_time}
+    return None
+
 # Function to categorize filenames based on prefixes
 def categorize_filenames(filenames):
     categorized = {'daily': [], 'yesterday': [], 'mtd': [], 'ytd': [], 'last': []}
@@ -272,13 +886,1128 @@ def categorize_filenames(filenames):
 
     return categorized
 
+# Query definitions of body/*.json and the compact spec, parsed and validated once and reloaded when the files change
+class QueryRegistry:
+    def __init__(self, body_path, spec_path, reload_interval):
+        self.body_path = body_path
+        self.spec_path = spec_path
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.checked_at = time.time()
+        self.signature = None
+        self.queries = {}
+        self.categorized = {}
+        self.reload()
+
+    # Function to fingerprint the query files by name, size and modification time
+    def _signature(self):
+        paths = [self.spec_path] if os.path.isfile(self.spec_path) else []
+        if os.path.isdir(self.body_path):
+            paths += [entry.path for entry in os.scandir(self.body_path) if entry.name.endswith('.json')]
+        signature = []
+        for path in sorted(paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def reload(self):
+        signature = self._signature()
+        queries = {}
+
+        # Reports generated from the compact spec, every period crossed with every dimension
+        if os.path.isfile(self.spec_path):
+            try:
+                with open(self.spec_path, 'r') as f:
+                    spec = json.load(f)
+                for period in spec.get('periods', []):
+                    for dimension, grouping in spec.get('dimensions', {}).items():
+                        payload = json.loads(json.dumps(QUERY_PERIODS[period]))
+                        if grouping:
+                            payload['dataset']['grouping'] = [grouping]
+                        self._add(queries, f"{period}-{dimension}", payload, self.spec_path)
+            except (ValueError, KeyError, TypeError) as e:
+                logging.warning(f"Ignoring invalid query spec {self.spec_path}: {e}")
+
+        # Hand written query bodies take precedence over the generated ones
+        if os.path.isdir(self.body_path):
+            for name in sorted(os.listdir(self.body_path)):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.body_path, name)
+                try:
+                    with open(path, 'r') as f:
+                        self._add(queries, name[:-5], json.load(f), path)
+                except ValueError as e:
+                    logging.warning(f"Ignoring invalid query body {path}: {e}")
+
+        categorized = categorize_filenames(sorted(queries))
+        with self.lock:
+            self.queries = queries
+            self.categorized = categorized
+            self.signature = signature
+        logging.info(f"Loaded {len(queries)} query definitions")
+
+    # Function to validate a query definition and index it by period and dimension
+    @staticmethod
+    def _add(queries, name, payload, source):
+        dataset = payload.get('dataset') if isinstance(payload, dict) else None
+        if not isinstance(dataset, dict) or 'aggregation' not in dataset or payload.get('timeframe') not in QUERY_TIMEFRAMES:
+            raise ValueError(f"{name} needs a dataset with an aggregation and one of the timeframes {', '.join(QUERY_TIMEFRAMES)}")
+        if payload['timeframe'] == 'Custom' and not isinstance(payload.get('timePeriod'), dict):
+            raise ValueError(f"{name} has a Custom timeframe without a timePeriod")
+
+        period = next((period for period in QUERY_PERIODS if name == period or name.startswith(period + '-')), None)
+        queries[name] = {
+            'name': name,
+            'period': period,
+            'dimension': name[len(period) + 1:] or None if period else None,
+            'grouping': dataset.get('grouping') or [],
+            # Kept serialized so every request gets its own copy to adjust
+            'template': json.dumps(payload),
+            'source': source
+        }
+
+    # Reload at most every reload_interval seconds, and only when a query file was added, changed or removed
+    def _check_for_changes(self):
+        if not self.reload_interval or time.time() - self.checked_at < self.reload_interval:
+            return
+        self.checked_at = time.time()
+        if self._signature() != self.signature:
+            logging.info("Query definitions changed, reloading")
+            self.reload()
+
+    def get(self, name):
+        self._check_for_changes()
+        with self.lock:
+            return self.queries.get(name)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def names(self, period=None, dimension=None):
+        self._check_for_changes()
+        with self.lock:
+            return sorted(name for name, query in self.queries.items()
+                          if (period is None or query['period'] == period) and (dimension is None or query['dimension'] == dimension))
+
+    # Function to return the name of the report of a period for a dimension, accepting singular dimension names
+    def find(self, period, dimension):
+        for candidate in (dimension, f"{dimension}s"):
+            names = self.names(period, candidate)
+            if names:
+                return names[0]
+        return None
+
+    def get_categorized(self):
+        self._check_for_changes()
+        with self.lock:
+            return self.categorized
+
+    # Function to return a fresh payload of a query with its time window applied, None for an unknown query
+    def payload(self, name, current_time=None):
+        query = self.get(name)
+        if query is None:
+            return None
+        payload = json.loads(query['template'])
+        time_period = query_time_period(query['period'], payload.get('timePeriod') or {}, current_time or datetime.now())
+        if time_period:
+            payload['timePeriod'] = time_period
+        return payload
+
+query_registry = QueryRegistry(QUERY_BODY_PATH, QUERY_SPEC_PATH, QUERY_RELOAD_INTERVAL)
+
+# Function to convert a date to the yyyymmdd integer used by UsageDate
+def date_to_int(value):
+    return int(value.strftime('%Y%m%d'))
+
+# Function to convert a yyyymmdd integer back to a date
+def int_to_date(value):
+    return datetime.strptime(str(value), '%Y%m%d').date()
+
+# Function to return the (from, to) dates a query body covers, or None if it cannot be computed locally
+def payload_window(payload):
+    today = datetime.now().date()
+    timeframe = payload.get('timeframe')
+    if timeframe == 'MonthToDate':
+        return today.replace(day=1), today
+    if timeframe == 'TheLastBillingMonth':
+        end_of_last_month = today.replace(day=1) - timedelta(days=1)
+        return end_of_last_month.replace(day=1), end_of_last_month
+    if timeframe == 'Custom':
+        period = payload.get('timePeriod', {})
+        if period.get('from') and period.get('to'):
+            return (datetime.strptime(period['from'][:10], '%Y-%m-%d').date(),
+                    datetime.strptime(period['to'][:10], '%Y-%m-%d').date())
+    return None
+
+# Local daily cost store, filled incrementally so MTD/YTD/last month/yesterday reports are aggregated locally
+class CostStore:
+    aggregation = QUERY_AGGREGATION
+
+    def __init__(self, path, restatement_days):
+        self.path = path
+        self.restatement_days = restatement_days
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS daily_costs (dimension TEXT NOT NULL, usage_date INTEGER NOT NULL, tag_key TEXT, value TEXT, currency TEXT, cost REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS daily_costs_dimension_date ON daily_costs (dimension, usage_date)')
+            connection.execute('CREATE TABLE IF NOT EXISTS sync_state (dimension TEXT PRIMARY KEY, synced_from INTEGER NOT NULL, synced_through INTEGER NOT NULL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def dimension_key(grouping):
+        return json.dumps(grouping or [], sort_keys=True)
+
+    # Only plain usage queries summing PreTaxCost per day or per period can be answered from the store
+    def supports(self, payload):
+        dataset = payload.get('dataset', {})
+        return (payload.get('type') == 'Usage' and dataset.get('aggregation') == self.aggregation
+                and 'filter' not in dataset and dataset.get('granularity') in ('None', 'Daily')
+                and payload_window(payload) is not None)
+
+    # Fetch daily costs of one grouping, re-fetching only the trailing restatement window once backfilled
+    def sync_dimension(self, scope, grouping, floor_date, today):
+        key = self.dimension_key(grouping)
+        with self._connect() as connection:
+            state = connection.execute('SELECT synced_from, synced_through FROM sync_state WHERE dimension = ?', (key,)).fetchone()
+
+        if state and state[0] <= date_to_int(floor_date):
+            synced_from = int_to_date(state[0])
+            start = max(synced_from, int_to_date(state[1]) - timedelta(days=self.restatement_days))
+        else:
+            synced_from = start = floor_date
+
+        current_query.set(f"cost-store/{key}")
+        url = f"{AZURE_MANAGEMENT_ENDPOINT}/{scope}/providers/Microsoft.CostManagement/query?api-version=2023-11-01"
+        chunk_start = start
+        while chunk_start <= today:
+            # Custom time periods are limited to one year per query
+            chunk_end = min(today, chunk_start + timedelta(days=364))
+            payload = {
+                'type': 'Usage',
+                'timeframe': 'Custom',
+                'timePeriod': {'from': f"{chunk_start:%Y-%m-%d}T00:00:00Z", 'to': f"{chunk_end:%Y-%m-%d}T23:59:59Z"},
+                'dataset': {'granularity': 'Daily', 'aggregation': self.aggregation, 'grouping': grouping}
+            }
+            with self._connect() as connection:
+                connection.execute('DELETE FROM daily_costs WHERE dimension = ? AND usage_date BETWEEN ? AND ?',
+                                   (key, date_to_int(chunk_start), date_to_int(chunk_end)))
+                # Pages are written as they arrive, so the backfill never holds a full year of rows in memory
+                for page in iter_result_pages(url, payload, max_rows=sys.maxsize):
+                    connection.executemany('INSERT INTO daily_costs VALUES (?, ?, ?, ?, ?, ?)',
+                                           self._page_rows(key, grouping, page))
+            chunk_start = chunk_end + timedelta(days=1)
+
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)', (key, date_to_int(synced_from), date_to_int(today)))
+
+    @staticmethod
+    def _page_rows(key, grouping, page):
+        columns = [col['name'] for col in page['properties']['columns']]
+        value_column = None
+        if grouping:
+            value_column = 'TagValue' if grouping[0]['type'] == 'TagKey' else grouping[0]['name']
+        for row in page['properties']['rows']:
+            record = dict(zip(columns, row))
+            yield (key, int(record['UsageDate']), record.get('TagKey'), record.get(value_column) if value_column else None,
+                   record.get('Currency'), float(record['PreTaxCost']))
+
+    def covers(self, payload):
+        window = payload_window(payload)
+        key = self.dimension_key(payload['dataset'].get('grouping'))
+        with self._connect() as connection:
+            state = connection.execute('SELECT synced_from, synced_through FROM sync_state WHERE dimension = ?', (key,)).fetchone()
+        if state is None:
+            return False
+        return state[0] <= date_to_int(window[0]) and state[1] >= date_to_int(min(window[1], datetime.now().date()))
+
+    # Aggregate the stored daily costs into a response shaped like the Cost Management query API
+    def query(self, payload):
+        window = payload_window(payload)
+        dataset = payload['dataset']
+        grouping = dataset.get('grouping') or []
+        daily = dataset.get('granularity') == 'Daily'
+
+        columns = [{'name': 'PreTaxCost', 'type': 'Number'}]
+        group_by = []
+        if daily:
+            columns.append({'name': 'UsageDate', 'type': 'Number'})
+            group_by.append('usage_date')
+        if grouping:
+            if grouping[0]['type'] == 'TagKey':
+                columns += [{'name': 'TagKey', 'type': 'String'}, {'name': 'TagValue', 'type': 'String'}]
+                group_by += ['tag_key', 'value']
+            else:
+                columns.append({'name': grouping[0]['name'], 'type': 'String'})
+                group_by.append('value')
+        columns.append({'name': 'Currency', 'type': 'String'})
+        group_by.append('currency')
+
+        sql = (f"SELECT SUM(cost), {', '.join(group_by)} FROM daily_costs WHERE dimension = ? AND usage_date BETWEEN ? AND ? "
+               f"GROUP BY {', '.join(group_by)} ORDER BY {', '.join(group_by)}")
+        with self._connect() as connection:
+            rows = connection.execute(sql, (self.dimension_key(grouping), date_to_int(window[0]), date_to_int(window[1]))).fetchall()
+        return {'properties': {'columns': columns, 'rows': [list(row) for row in rows], 'nextLink': None}}
+
+    # Function to return the (from, through) dates synced for a grouping, or None if it was never synced
+    def synced_range(self, grouping):
+        with self._connect() as connection:
+            state = connection.execute('SELECT synced_from, synced_through FROM sync_state WHERE dimension = ?',
+                                       (self.dimension_key(grouping),)).fetchone()
+        return (int_to_date(state[0]), int_to_date(state[1])) if state else None
+
+    def status(self):
+        with self._connect() as connection:
+            states = connection.execute('SELECT s.dimension, s.synced_from, s.synced_through, COUNT(c.dimension) FROM sync_state s '
+                                        'LEFT JOIN daily_costs c ON c.dimension = s.dimension GROUP BY s.dimension').fetchall()
+        return [{'grouping': json.loads(key), 'synced_from': str(synced_from), 'synced_through': str(synced_through), 'rows': rows}
+                for key, synced_from, synced_through, rows in states]
+
+cost_store = CostStore(COST_STORE_PATH, COST_STORE_RESTATEMENT_DAYS) if COST_STORE_ENABLED else None
+
+# Function to bring the cost store up to date for every grouping used by the query bodies
+def sync_cost_store():
+    today = datetime.now().date()
+    groupings = {}
+    floor_date = (today.replace(day=1) - timedelta(days=1)).replace(day=1)
+    for filename in query_registry.names():
+        if filename == 'forecast':
+            continue
+        json_data = query_registry.payload(filename)
+        if not cost_store.supports(json_data):
+            continue
+        grouping = json_data['dataset'].get('grouping') or []
+        groupings[CostStore.dimension_key(grouping)] = grouping
+        # Backfill far enough back for the earliest window any report asks for
+        floor_date = min(floor_date, payload_window(json_data)[0])
+
+    for grouping in groupings.values():
+        try:
+            cost_store.sync_dimension(scope, grouping, floor_date, today)
+        except requests.RequestException as e:
+            logging.warning(f"Cost store sync failed for grouping {grouping}: {e}")
+
+# Function to execute a named query body once against the Cost Management API
+def run_query(filename, query_scope=None, use_cache=True):
+    current_query.set(filename)
+    query_scope = query_scope or scope
+    json_data = query_registry.payload(filename)
+    if json_data is None:
+        return None, f"Unknown query: {filename}", 404
+
+    if filename == 'forecast':
+        # Project the month from the daily history, the Azure forecast endpoint is only needed while there is too little of it
+        if LOCAL_FORECAST_ENABLED and query_scope == scope:
+            response = local_forecast_response()
+            if response:
+                return response, None, 200
+        return make_post_request_forecast_api(query_scope, json_data, use_cache)
+
+    # Aggregate locally when the cost store already holds the daily costs for this window (it only syncs SCOPE)
+    if cost_store and query_scope == scope and cost_store.supports(json_data) and cost_store.covers(json_data):
+        return cost_store.query(json_data), None, 200
+    return make_post_request_api(query_scope, json_data, use_cache=use_cache)
+
+# Function to execute a named query body like run_query, but return the result with its rows in a compact DataFrame
+# built page by page, the merged JSON of run_query is only needed by the raw JSON API
+def run_result_query(filename, query_scope=None, use_cache=True, store_result=True):
+    current_query.set(filename)
+    query_scope = query_scope or scope
+    json_data = query_registry.payload(filename)
+    if json_data is None:
+        return None, f"Unknown query: {filename}", 404
+
+    # Forecasts and cost store aggregates are small, take them as they are
+    if filename == 'forecast' or (cost_store and query_scope == scope and cost_store.supports(json_data) and cost_store.covers(json_data)):
+        response, error, status_code = run_query(filename, query_scope, use_cache)
+        return (result_frame_from_pages([response]) if response else None), error, status_code
+
+    url = f"{AZURE_MANAGEMENT_ENDPOINT}/{query_scope}/providers/Microsoft.CostManagement/query?api-version=2023-11-01"
+    try:
+        return fetch_result_frame(url, json_data, use_cache, store_result), None, 200
+    except requests.RequestException as e:
+        return None, str(e), 500
+
+# Function to execute many named query bodies concurrently, returns {filename: (response, error, status_code)}
+def execute_queries(filenames, max_workers=BATCH_MAX_CONCURRENCY, run=run_query):
+    filenames = list(dict.fromkeys(filenames))
+    if not filenames:
+        return {}
+    # Upstream concurrency is still capped by the request scheduler
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(filenames))) as executor:
+        results = executor.map(run, filenames)
+        return dict(zip(filenames, results))
+
+# Concurrency limit per scope, so a few slow scopes cannot hold every scheduler slot during a consolidated query
+scope_slots_lock = threading.Lock()
+scope_slots = {}
+
+# Function to execute a named query body against one scope, waiting for a free slot of that scope (SCOPE's report is taken
+# from the snapshot once warmed, other scopes are answered from the result cache when possible)
+def run_scope_query(filename, query_scope):
+    if query_scope == scope:
+        entry = get_snapshot_report(filename)
+        if entry:
+            return entry['result'], None, 200
+    with scope_slots_lock:
+        slot = scope_slots.setdefault(query_scope, threading.BoundedSemaphore(SCOPE_MAX_CONCURRENT_QUERIES))
+    with slot:
+        return run_result_query(filename, query_scope)
+
+# Function to execute a named query body against many scopes concurrently, returns {scope: (result, error, status_code)}
+def execute_scope_queries(filename, query_scopes, max_workers=CONSOLIDATION_MAX_CONCURRENCY):
+    query_scopes = list(dict.fromkeys(query_scopes))
+    if not query_scopes:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(query_scopes))) as executor:
+        results = executor.map(lambda query_scope: run_scope_query(filename, query_scope), query_scopes)
+        return dict(zip(query_scopes, results))
+
+# Function to label a scope by its last path segment (billing account, subscription or management group ID)
+def scope_label(query_scope):
+    return query_scope.rsplit('/', 1)[-1]
+
+# Function to sum the costs of a consolidated report over every scope, per dimension value
+def consolidate_totals(df):
+    cost_columns = list(df.drop(columns=['Scope:']).select_dtypes(include='number').columns)
+    dimensions = [col for col in df.columns if col != 'Scope:' and col not in cost_columns]
+    if not dimensions:
+        return df[cost_columns].sum().to_frame().T
+    return df.groupby(dimensions, sort=False, dropna=False, observed=True)[cost_columns].sum().reset_index()
+
+# Function to query a report for every scope and merge the results, returns (DataFrame with a Scope: column, totals, {scope: error})
+def consolidate_report(filename, query_scopes):
+    frames = []
+    errors = {}
+    for query_scope, (result, error, status_code) in execute_scope_queries(filename, query_scopes).items():
+        if result is None:
+            logging.warning(f"Consolidated query {filename} failed for {query_scope} ({status_code}): {error}")
+            errors[query_scope] = error
+            continue
+        df = prepare_report_dataframe(build_result_dataframe(result))
+        df.insert(0, 'Scope:', scope_label(query_scope))
+        frames.append(df)
+
+    if not frames:
+        return None, None, errors
+    df = categorize_dimension_columns(pd.concat(frames, ignore_index=True))
+    return df, consolidate_totals(df), errors
+
+# Function to consolidate a report over many scopes as a (response, error, status_code) job result, the response being
+# the JSON served by /api/consolidated
+def run_consolidated_query(filename, query_scopes):
+    current_query.set(filename)
+    df, totals, errors = consolidate_report(filename, query_scopes)
+    if df is None:
+        return None, f"No data retrieved for {filename}: {errors}", 502
+    return {
+        'report': filename,
+        'scopes': query_scopes,
+        'columns': list(df.columns),
+        'rows': dataframe_rows(df),
+        'totals': {'columns': list(totals.columns), 'rows': dataframe_rows(totals)},
+        'total_cost': float(df['PreTaxCost'].sum()) if 'PreTaxCost' in df.columns else None,
+        'errors': errors,
+        'refreshed_at': datetime.now(pytz.utc).isoformat()
+    }, None, 200
+
+# Function to start (or join) the consolidation job of a report over some scopes
+def submit_consolidated_query(filename, query_scopes):
+    return query_jobs.submit(f"consolidated/{filename}/{','.join(query_scopes)}", run_consolidated_query, filename, query_scopes,
+                             job_id=request.args.get('job'))
+
+# Function to fetch the consumption commitment lots as a (response, error, status_code) job result
+def run_consumption_query():
+    consumption_data = fetch_consumption_data()
+    if consumption_data:
+        return consumption_data['value'], None, 200
+    return None, "Failed to fetch consumption data", 500
+
+# Background query jobs, so calls waiting on a throttled Azure API hold a job thread instead of a web worker
+class QueryJobs:
+    def __init__(self, max_workers, retention):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='query-job')
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.active = {}
+
+    # Requests for a query that is already queued or running share its job instead of queueing another one, a poll
+    # (job_id set) gets the job it polls while this worker still has it and otherwise joins or starts the key's job
+    def submit(self, key, func, *args, job_id=None):
+        with self.lock:
+            self._expire()
+            job_id = self.active.get(key) or (job_id if job_id in self.jobs and self.jobs[job_id]['key'] == key else None)
+            if job_id:
+                return self.jobs[job_id]
+            job = {'id': uuid.uuid4().hex, 'key': key, 'status': 'pending', 'created_at': time.time(),
+                   'finished_at': None, 'result': None, 'done': threading.Event()}
+            self.jobs[job['id']] = job
+            self.active[key] = job['id']
+        self.executor.submit(self._run, job, func, args)
+        return job
+
+    def _run(self, job, func, args):
+        job['status'] = 'running'
+        try:
+            result = func(*args)
+        except Exception as e:
+            logging.exception(f"Job {job['key']} crashed")
+            result = (None, str(e), 500)
+        if result[0] is None:
+            logging.warning(f"Job {job['key']} failed: {result[1]}")
+        with self.lock:
+            job['result'] = result
+            job['status'] = 'done' if result[0] is not None else 'failed'
+            job['finished_at'] = time.time()
+            del self.active[job['key']]
+        job['done'].set()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    # Forget finished jobs once their result was kept for the retention period
+    def _expire(self):
+        cutoff = time.time() - self.retention
+        for job_id in [job_id for job_id, job in self.jobs.items() if job['finished_at'] and job['finished_at'] < cutoff]:
+            del self.jobs[job_id]
+
+    def status(self):
+        with self.lock:
+            statuses = [job['status'] for job in self.jobs.values()]
+        return {status: statuses.count(status) for status in ('pending', 'running', 'done', 'failed')}
+
+query_jobs = QueryJobs(JOB_MAX_WORKERS, JOB_RETENTION)
+
+# Function to read the seconds a client is willing to wait for a job (?wait=), capped by JOB_MAX_WAIT
+def requested_wait(default):
+    try:
+        return min(max(float(request.args.get('wait', default)), 0.0), JOB_MAX_WAIT)
+    except ValueError:
+        return default
+
+# Function to return the poll URL of a job: the API route of its key, so whichever worker the poll reaches can answer it
+# from its own copy of the job or join or start the job for that key
+def job_poll_url(job):
+    kind, _, name = job['key'].partition('/')
+    if kind == 'query':
+        return url_for('display_result_api', filename=name, job=job['id'])
+    if kind == 'consolidated':
+        filename, _, query_scopes = name.partition('/')
+        return url_for('display_consolidated_result_api', filename=filename, scopes=query_scopes, job=job['id'])
+    return url_for('get_consumption_data', job=job['id'])
+
+# Function to answer with the result of a job if it finishes within wait seconds, otherwise 202 and the URL to poll
+def job_response(job, wait):
+    job['done'].wait(wait)
+    if job['status'] == 'done':
+        return jsonify(job['result'][0])
+    if job['status'] == 'failed':
+        response, error, status_code = job['result']
+        return jsonify({"error": error}), status_code or 500
+
+    poll_url = job_poll_url(job)
+    response = jsonify({'job': job['id'], 'status': job['status'], 'poll': poll_url})
+    response.status_code = 202
+    response.headers['Location'] = poll_url
+    # Clients sleep for Retry-After between polls instead of holding a worker with a long ?wait=
+    response.headers['Retry-After'] = str(JOB_POLL_INTERVAL)
+    return response
+
+# Function to cache only complete answers, never errors or pending job responses
+def is_complete_response(rv):
+    return not isinstance(rv, tuple) and getattr(rv, 'status_code', 200) == 200
+
+# Function to select the configured scopes named in ?scopes= (full scope or its label), every scope by default
+def requested_scopes():
+    names = [name.strip().strip('/') for name in request.args.get('scopes', '').split(',') if name.strip()]
+    if not names:
+        return scopes
+    return [query_scope for query_scope in scopes if query_scope in names or scope_label(query_scope) in names]
+
+# Latest snapshot of every query body, swapped atomically by the background warmer
+snapshot_lock = threading.Lock()
+snapshot = {'version': 0, 'refreshed_at': None, 'reports': {}}
+
+# Function to return the snapshot entry of a report, or None if it has not been warmed yet
+def get_snapshot_report(filename):
+    with snapshot_lock:
+        entry = snapshot['reports'].get(filename)
+    record_cache_lookup('snapshot', entry is not None)
+    return entry
+
+# Function to build the snapshot entry of a report: its result (served by the raw JSON API and scanned for anomalies)
+# and the processed DataFrame its pages, tables and exports are served from, both measured for /api/memory
+def snapshot_entry(result, version):
+    df = prepare_report_dataframe(build_result_dataframe(result))
+    return {'result': result, 'df': df, 'refreshed_at': datetime.now(pytz.utc), 'version': version,
+            'memory': {'result': dataframe_memory(result['frame']), 'processed': dataframe_memory(df)}}
+
+# Function to execute every query body and publish the results as a new snapshot version
+def refresh_snapshot():
+    global snapshot
+    filenames = query_registry.names()
+
+    if cost_store:
+        sync_cost_store()
+
+    with snapshot_lock:
+        reports = dict(snapshot['reports'])
+        version = snapshot['version'] + 1
+
+    # Results are kept as compact DataFrames, the raw rows of a report are never held all at once. The result cache is
+    # bypassed so a result cached up to RESULT_CACHE_TTL ago is never stamped with this refresh time, and not written
+    # either: SCOPE's reports are read from the snapshot from now on
+    fresh_result_query = lambda filename: run_result_query(filename, use_cache=False, store_result=False)
+    results = execute_queries([filename for filename in filenames if filename != 'forecast'], run=fresh_result_query)
+    for filename, (result, error, status_code) in results.items():
+        if result:
+            reports[filename] = snapshot_entry(result, version)
+
+    # Score the days that just arrived while the data is fresh, the local forecast is then fit on the same history. This
+    # is the only place the anomaly history is updated, requests only read it
+    try:
+        update_anomalies(reports)
+    except Exception:
+        logging.exception("Anomaly update failed")
+    if 'forecast' in filenames:
+        result, error, status_code = results['forecast'] = fresh_result_query('forecast')
+        if result:
+            reports['forecast'] = snapshot_entry(result, version)
+
+    failed = []
+    for filename, (result, error, status_code) in results.items():
+        if not result:
+            # Keep serving the previous result until the next refresh succeeds
+            logging.warning(f"Snapshot refresh failed for {filename} ({status_code}): {error}")
+            failed.append(filename)
+
+    # The anomaly history is published with the reports so the other workers serve the same anomalies and forecasts
+    with snapshot_lock:
+        snapshot = {'version': version, 'refreshed_at': datetime.now(pytz.utc), 'reports': reports,
+                    'anomalies': anomaly_detector.states()}
+
+    logging.info(f"Snapshot {version} refreshed {len(filenames) - len(failed)}/{len(filenames)} reports")
+    return failed
+
+# Function to take the refresh lock without blocking, it is held until the process exits so a single worker refreshes
+def acquire_refresh_lock(path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle = open(path, 'a+b')
+    try:
+        if fcntl:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        handle.close()
+        return None
+    return handle
+
+# Layout of the snapshot entries, a snapshot published by an older version of the app is never loaded
+SNAPSHOT_FORMAT = 2
+
+# Function to write the current snapshot for the other workers, replaced atomically so they never read a partial file
+def publish_snapshot(path):
+    with snapshot_lock:
+        current = snapshot
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'wb') as f:
+        pickle.dump({'format': SNAPSHOT_FORMAT, 'snapshot': current}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_path, path)
+
+published_snapshot_mtime = None
+
+# Function to load the snapshot published by the refreshing worker when it changed and is newer than the one in memory
+def load_published_snapshot(path):
+    global snapshot, published_snapshot_mtime
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        if mtime == published_snapshot_mtime:
+            return False
+        with open(path, 'rb') as f:
+            published = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        if not isinstance(e, FileNotFoundError):
+            logging.warning(f"Could not load the published snapshot {path}: {e}")
+        return False
+    published_snapshot_mtime = mtime
+    if not isinstance(published, dict) or published.get('format') != SNAPSHOT_FORMAT:
+        logging.warning(f"Ignoring the published snapshot {path}, it was written in an older format")
+        return False
+    published = published['snapshot']
+    with snapshot_lock:
+        if published['version'] <= snapshot['version']:
+            return False
+        snapshot = published
+    anomaly_detector.restore(published.get('anomalies', {}))
+    logging.info(f"Loaded published snapshot {published['version']}")
+    return True
+
+# Function to refresh and publish the snapshot periodically from a single worker, the others load what it publishes
+# and take over the refresh when it exits
+def snapshot_warmer_loop():
+    refresh_lock = None
+    while refresh_lock is None:
+        refresh_lock = acquire_refresh_lock(SNAPSHOT_LOCK_PATH)
+        load_published_snapshot(SNAPSHOT_PATH)
+        if refresh_lock is None:
+            time.sleep(SNAPSHOT_POLL_INTERVAL)
+
+    # A snapshot published by a previous refresher is only refreshed once it is due
+    with snapshot_lock:
+        refreshed_at = snapshot['refreshed_at']
+    if refreshed_at:
+        time.sleep(max(0.0, SNAPSHOT_REFRESH_INTERVAL - (datetime.now(pytz.utc) - refreshed_at).total_seconds()))
+
+    while True:
+        try:
+            failed = refresh_snapshot()
+            publish_snapshot(SNAPSHOT_PATH)
+        except Exception:
+            logging.exception("Snapshot refresh crashed")
+            failed = True
+        time.sleep(SNAPSHOT_RETRY_INTERVAL if failed else SNAPSHOT_REFRESH_INTERVAL)
+
+# Function to start the background snapshot warmer thread
+def start_snapshot_warmer():
+    thread = threading.Thread(target=snapshot_warmer_loop, name='snapshot-warmer', daemon=True)
+    thread.start()
+    return thread
+
+snapshot_warmer_lock = threading.Lock()
+snapshot_warmer_pid = None
+
+# Function to start the warmer once in the process serving requests. It is never started at import: a preloading
+# gunicorn master would otherwise refresh itself and fork workers while the warmer holds one of the app's locks
+def ensure_snapshot_warmer():
+    global snapshot_warmer_pid
+    if not ENABLE_SNAPSHOT_WARMER or snapshot_warmer_pid == os.getpid():
+        return
+    with snapshot_warmer_lock:
+        if snapshot_warmer_pid != os.getpid():
+            snapshot_warmer_pid = os.getpid()
+            start_snapshot_warmer()
+
+# Function to format a snapshot timestamp in the dashboard timezone
+def format_refreshed_at(refreshed_at):
+    desired_timezone = pytz.timezone('America/Los_Angeles')
+    return refreshed_at.astimezone(desired_timezone).strftime("%B %d, %Y %H:%M:%S")
+
+# Function to key cached views by path and snapshot version so a refresh invalidates them
+def snapshot_cache_key():
+    with snapshot_lock:
+        version = snapshot['version']
+    return f"view/{request.path}/{version}"
+
+# Function to pivot a daily query response into a DataFrame of costs with one row per dimension value and one column per day
+def daily_cost_frame(result):
+    frame = result['frame']
+    if frame.empty:
+        return pd.DataFrame(dtype=float)
+
+    value_column = next((col for col in frame.columns if col not in ('PreTaxCost', 'UsageDate', 'TagKey', 'Currency')), None)
+    if value_column:
+        # Label each distinct value once, missing values (code -1) pick the trailing '' label
+        values = frame[value_column].astype('category').cat.remove_unused_categories()
+        codes = values.cat.codes.to_numpy()
+        labels = values.cat.categories.astype(str).to_numpy(dtype=object)
+        if (codes < 0).any():
+            labels = np.append(labels, '')
+        label_codes, groups = pd.factorize(labels)
+        group_codes, groups = label_codes[codes], list(groups)
+    else:
+        group_codes, groups = np.zeros(len(frame), dtype=np.intp), ['Total']
+    date_codes, usage_dates = pd.factorize(frame['UsageDate'].to_numpy(dtype=np.int64))
+    row_costs = frame['PreTaxCost'].to_numpy(dtype=float)
+
+    # Every day between the first and last usage date gets a column, days without costs are 0
+    days = pd.to_datetime(pd.Series(usage_dates).astype(str), format='%Y%m%d')
+    dates = pd.date_range(days.min(), days.max(), freq='D')
+    day_index = (days - dates[0]).dt.days.to_numpy()[date_codes]
+    costs = np.bincount(group_codes * len(dates) + day_index, weights=row_costs,
+                        minlength=len(groups) * len(dates))
+    return pd.DataFrame(costs.reshape(len(groups), len(dates)), index=pd.Index(groups, name='group'), columns=dates)
+
+# Function to score days window..n of every row of a (groups x days) cost matrix against the median and
+# median absolute deviation (MAD) of the window days before each of them, returns (expected costs, z-scores)
+def robust_zscores(costs, window, min_scale=0.01):
+    # Sorting the short windows once is several times faster than np.median, which partitions a copy per call
+    low, high = (window - 1) // 2, window // 2
+    baselines = np.sort(sliding_window_view(costs, window, axis=1)[:, :-1], axis=-1)
+    expected = (baselines[..., low] + baselines[..., high]) / 2
+    deviations = np.abs(baselines - expected[..., None])
+    deviations.sort(axis=-1)
+    mad = (deviations[..., low] + deviations[..., high]) / 2
+    # 1.4826 * MAD estimates the standard deviation; flat series fall back to 5% of the expected cost or min_scale
+    scale = np.maximum(1.4826 * mad, np.maximum(0.05 * np.abs(expected), min_scale))
+    return expected, (costs[:, window:] - expected) / scale
+
+# Daily cost history and detected spikes per daily report, updated incrementally as new days arrive
+class AnomalyDetector:
+    def __init__(self, window, threshold, min_increase, history_days, restatement_days):
+        self.window = window
+        self.threshold = threshold
+        self.min_increase = min_increase
+        self.history_days = history_days
+        self.restatement_days = restatement_days
+        self.lock = threading.Lock()
+        self.reports = {}
+
+    # Merge newly retrieved daily costs into the history of a report and score only the days that are new or restated,
+    # source_version is the snapshot version of the costs (None when queried live), older versions are ignored
+    def update(self, report, result, source_version=None):
+        with self.lock:
+            state = self.reports.get(report)
+        if state and None not in (source_version, state['source_version']) and source_version <= state['source_version']:
+            return state
+
+        latest = daily_cost_frame(result)
+        history = latest if state is None else self.merge(state['history'], latest)
+        if history.empty:
+            return state
+        # Reports are billed in one currency, kept for the forecasts fit on this history
+        currencies = result['frame']['Currency'].dropna() if 'Currency' in result['frame'].columns else ()
+        currency = str(currencies.iloc[0]) if len(currencies) else (state or {}).get('currency')
+        history = history.loc[:, history.columns[-self.history_days:]]
+
+        rescore_from = history.columns[0]
+        anomalies = None
+        if state and state['scored_through'] is not None:
+            # Days before the restatement window keep the anomalies found when they first arrived
+            rescore_from = state['scored_through'] - pd.Timedelta(days=self.restatement_days - 1)
+            anomalies = state['anomalies'][(state['anomalies']['date'] < rescore_from) & (state['anomalies']['date'] >= history.columns[0])]
+
+        found = self.score(history, max(self.window, history.columns.searchsorted(rescore_from)))
+        if anomalies is not None and len(anomalies):
+            found = pd.concat([anomalies, found], ignore_index=True) if len(found) else anomalies
+
+        state = {'history': history, 'anomalies': found, 'source_version': source_version, 'currency': currency,
+                 'scored_through': history.columns[-1] if len(history.columns) > self.window else None,
+                 'updated_at': datetime.now(pytz.utc)}
+        with self.lock:
+            self.reports[report] = state
+        return state
+
+    # Function to overwrite the history with the days of the latest response, adding new dimension values and days
+    @staticmethod
+    def merge(history, latest):
+        if latest.empty:
+            return history
+        groups = history.index.append(latest.index.difference(history.index, sort=False))
+        # One column per day even when refreshes were missed
+        dates = pd.date_range(min(history.columns[0], latest.columns[0]), max(history.columns[-1], latest.columns[-1]), freq='D')
+        costs = history.reindex(index=groups, columns=dates, fill_value=0.0).to_numpy()
+        costs[np.ix_(groups.get_indexer(latest.index), dates.get_indexer(latest.columns))] = latest.to_numpy()
+        return pd.DataFrame(costs, index=groups, columns=dates)
+
+    # Function to flag every (dimension value, day) from column start on whose cost spikes above its trailing window
+    def score(self, history, start):
+        if start >= len(history.columns):
+            return pd.DataFrame(columns=['group', 'date', 'cost', 'expected', 'previous_day', 'zscore'])
+        costs = history.to_numpy()[:, start - self.window:]
+        # Spend appearing on a flat or empty series scores the threshold once it grows by min_increase
+        expected, zscores = robust_zscores(costs, self.window, self.min_increase / self.threshold)
+        actual = costs[:, self.window:]
+        previous = costs[:, self.window - 1:-1]
+        rows, days = np.nonzero((zscores >= self.threshold) & (actual - expected >= self.min_increase))
+        return pd.DataFrame({
+            'group': history.index.to_numpy()[rows],
+            'date': history.columns[start:][days],
+            'cost': actual[rows, days],
+            'expected': expected[rows, days],
+            'previous_day': previous[rows, days],
+            'zscore': zscores[rows, days]
+        })
+
+    # Function to return the state of every report, states are replaced rather than modified so they can be shared
+    def states(self):
+        with self.lock:
+            return dict(self.reports)
+
+    # Function to take over the states published by the refreshing worker
+    def restore(self, states):
+        with self.lock:
+            self.reports = dict(states)
+
+    def status(self):
+        with self.lock:
+            return {report: {'groups': len(state['history'].index), 'days': len(state['history'].columns),
+                             'scored_through': str(state['scored_through'].date()) if state['scored_through'] is not None else None,
+                             'anomalies': len(state['anomalies']), 'updated_at': state['updated_at'].isoformat()}
+                    for report, state in self.reports.items()}
+
+anomaly_detector = AnomalyDetector(ANOMALY_WINDOW_DAYS, ANOMALY_THRESHOLD, ANOMALY_MIN_INCREASE, DAILY_HISTORY_DAYS,
+                                   COST_STORE_RESTATEMENT_DAYS)
+
+# Function to return the daily costs of a daily-* report and their snapshot version, from the cost store when it
+# holds more days than the report, reports maps report names to the snapshot entries being refreshed
+def anomaly_history(filename, reports):
+    entry = reports.get(filename)
+    if cost_store:
+        json_data = query_registry.payload(filename)
+        grouping = json_data['dataset'].get('grouping') or []
+        synced = cost_store.synced_range(grouping) if cost_store.supports(json_data) else None
+        if synced:
+            start = max(synced[0], synced[1] - timedelta(days=DAILY_HISTORY_DAYS - 1))
+            payload = {'type': 'Usage', 'timeframe': 'Custom',
+                       'timePeriod': {'from': f"{start:%Y-%m-%d}T00:00:00Z", 'to': f"{synced[1]:%Y-%m-%d}T23:59:59Z"},
+                       'dataset': {'granularity': 'Daily', 'aggregation': CostStore.aggregation, 'grouping': grouping}}
+            return result_frame_from_pages([cost_store.query(payload)]), entry['version'] if entry else None
+    if entry:
+        return entry['result'], entry['version']
+    return None, None
+
+# Function to update the anomaly history of every daily report from the snapshot reports being refreshed, reports
+# missing from it keep their current history until a later refresh retrieves them
+def update_anomalies(reports, filenames=None):
+    for filename in filenames or query_registry.names(period='daily'):
+        result, source_version = anomaly_history(filename, reports)
+        if result is not None:
+            anomaly_detector.update(filename, result, source_version)
+
+# Function to return the daily cost history state of a daily-* report as of the last snapshot refresh, None before it
+def daily_history_state(filename):
+    with anomaly_detector.lock:
+        return anomaly_detector.reports.get(filename)
+
+# Function to fit a linear trend with day-of-week factors to the complete days of a (groups x days) cost history, all groups
+# at once, and project each group to period_end, returns (actual, projected, lower, upper) per group or None without enough days
+def forecast_period(history, period_start, period_end, today):
+    complete = history.loc[:, history.columns < today]
+    # Costs usually arrive within 72 hours, an older history is stale rather than just incomplete
+    if len(complete.columns) < FORECAST_MIN_DAYS or complete.columns[-1] < today - pd.Timedelta(days=3):
+        return None
+    fit = complete.iloc[:, -FORECAST_FIT_DAYS:]
+    costs = fit.to_numpy()
+    groups, n = costs.shape
+    weekdays = fit.columns.dayofweek.to_numpy()
+
+    # Day-of-week factors (average cost of a weekday over the average cost), only once every weekday was seen twice
+    factors = np.ones((groups, 7))
+    average = costs.mean(axis=1)
+    if n >= 14:
+        for weekday in range(7):
+            factors[:, weekday] = np.divide(costs[:, weekdays == weekday].mean(axis=1), average, out=np.ones(groups), where=average > 0)
+    factors = np.where(factors > 0, factors, 1.0)
+
+    # Least squares trend of the deseasonalized costs
+    adjusted = costs / factors[:, weekdays]
+    x = np.arange(n)
+    x_mean = x.mean()
+    sxx = ((x - x_mean) ** 2).sum()
+    y_mean = adjusted.mean(axis=1)
+    slope = (adjusted - y_mean[:, None]) @ (x - x_mean) / sxx
+    intercept = y_mean - slope * x_mean
+    residuals = adjusted - (intercept[:, None] + slope[:, None] * x)
+    sigma = np.sqrt((residuals ** 2).sum(axis=1) / max(n - 2, 1))
+
+    actual = complete.loc[:, complete.columns >= period_start].to_numpy().sum(axis=1)
+    future = pd.date_range(today, period_end, freq='D')
+    x_future = n - 1 + (future - fit.columns[-1]).days.to_numpy()
+    seasonal = factors[:, future.dayofweek.to_numpy()]
+    remaining = (np.clip(intercept[:, None] + slope[:, None] * x_future, 0, None) * seasonal).sum(axis=1)
+
+    # Variance of the summed daily errors plus the uncertainty of the fitted intercept and slope
+    h = len(future)
+    variance = sigma ** 2 * (h + h ** 2 / n + (x_future - x_mean).sum() ** 2 / sxx) * seasonal.mean(axis=1) ** 2 if h else np.zeros(groups)
+    margin = statistics.NormalDist().inv_cdf((1 + FORECAST_INTERVAL) / 2) * np.sqrt(variance)
+    return pd.DataFrame({'actual': actual, 'forecast': actual + remaining, 'lower': actual + np.clip(remaining - margin, 0, None),
+                         'upper': actual + remaining + margin, 'variance': variance}, index=history.index)
+
+# Function to project a daily report to the end of the current month and quarter, returns {period: details} or None,
+# a period is None while the history does not reach back to its start
+def forecast_report(filename):
+    state = daily_history_state(filename)
+    if state is None or state['history'].empty:
+        return None
+    history = state['history']
+    today = pd.Timestamp(datetime.now().date())
+    month_start = today.replace(day=1)
+    quarter_start = month_start.replace(month=3 * ((today.month - 1) // 3) + 1)
+    periods = {'month': (month_start, month_start + pd.offsets.MonthEnd(0)),
+               'quarter': (quarter_start, quarter_start + pd.offsets.QuarterEnd(0))}
+
+    forecasts = {}
+    for period, (period_start, period_end) in periods.items():
+        projection = forecast_period(history, period_start, period_end, today)
+        if projection is None:
+            return None
+        # The costs before the history started are unknown, so the period's actual and forecast would be too low
+        if history.columns[0] > period_start:
+            forecasts[period] = None
+            continue
+        # Groups are assumed independent, so their variances add up for the total
+        total_margin = statistics.NormalDist().inv_cdf((1 + FORECAST_INTERVAL) / 2) * np.sqrt(projection['variance'].sum())
+        total_actual, total_forecast = projection['actual'].sum(), projection['forecast'].sum()
+        forecasts[period] = {
+            'start': f"{period_start:%Y-%m-%d}",
+            'end': f"{period_end:%Y-%m-%d}",
+            'currency': state['currency'],
+            'total': {'actual': total_actual, 'forecast': total_forecast,
+                      'lower': max(total_actual, total_forecast - total_margin), 'upper': total_forecast + total_margin},
+            'groups': projection.drop(columns=['variance']).sort_values('forecast', ascending=False)
+        }
+    return forecasts
+
+# Function to answer the forecast query from the daily grand total history, shaped like the Cost Management forecast API
+def local_forecast_response():
+    forecasts = forecast_report('daily-grand-total')
+    # Without the whole month of history or its currency the Azure forecast is used instead
+    if forecasts is None or forecasts['month'] is None or not forecasts['month']['currency']:
+        return None
+    month, currency = forecasts['month']['total'], forecasts['month']['currency']
+    return {'properties': {
+        'columns': [{'name': 'Cost', 'type': 'Number'}, {'name': 'CostStatus', 'type': 'String'}, {'name': 'Currency', 'type': 'String'}],
+        'rows': [[round(float(month['actual']), 4), 'Actual', currency], [round(float(month['forecast'] - month['actual']), 4), 'Forecast', currency]],
+        'nextLink': None}}
+
+# Function to drop the rows a report never displays
+def prepare_report_dataframe(df):
+    with dataframe_step_timer('zero_filter'):
+        df = remove_rows_with_zero(df)
+    with dataframe_step_timer('empty_filter'):
+        return remove_rows_with_empty_cells(df)
+
+# Function to measure the memory held by a report DataFrame, in total and per column
+def dataframe_memory(df):
+    usage = df.memory_usage(deep=True, index=True)
+    return {
+        'rows': len(df),
+        'bytes': int(usage.sum()),
+        'columns': {col: {'dtype': str(df[col].dtype), 'bytes': int(usage[col])} for col in df.columns}
+    }
+
+# Function to return the processed DataFrame of a report and its snapshot entry (None when queried live)
+def get_report_dataframe(filename):
+    # Snapshot reports are processed once by the refresh
+    entry = get_snapshot_report(filename)
+    if entry:
+        return entry['df'], entry
+
+    # Reports not warmed yet are kept in the view cache for the lifetime a shared result would have
+    cache_key = f"report-dataframe/{filename}"
+    df = cache.get(cache_key)
+    record_cache_lookup('processed', df is not None)
+    if df is None:
+        result, error, status_code = run_result_query(filename)
+        if result is None:
+            return None, None
+        df = prepare_report_dataframe(build_result_dataframe(result))
+        cache.set(cache_key, df, timeout=result_cache_ttl(query_registry.payload(filename)))
+    return df, None
+
+# Function to match a user supplied column name ("owner", "resource group", "cost") to a report column
+def resolve_report_column(df, name):
+    normalized = name.lower().replace(':', '').replace('-', ' ').replace('_', ' ').strip()
+    if normalized == 'cost':
+        normalized = 'pretaxcost'
+    for col in df.columns:
+        if col.lower().replace(':', '').strip() == normalized:
+            return col
+    return None
+
+# Rendered report pages of the current snapshot, keyed by report and the snapshot version it was refreshed in
+rendered_pages_lock = threading.Lock()
+rendered_pages = {}
+
+# Function to return the cached page of a report if it was rendered from the same snapshot version
+def get_rendered_page(page_key, version):
+    with rendered_pages_lock:
+        page = rendered_pages.get(page_key)
+    hit = bool(page and page['version'] == version)
+    record_cache_lookup('render', hit)
+    return page if hit else None
+
+# Function to cache a rendered page, its ETag is derived from the content so it is the same on every worker
+def store_rendered_page(page_key, entry, html):
+    page = {'version': entry['version'], 'html': html, 'etag': hashlib.sha1(html.encode()).hexdigest(),
+            'last_modified': entry['refreshed_at']}
+    with rendered_pages_lock:
+        rendered_pages[page_key] = page
+    return page
+
+# Function to answer with a cached page, or 304 when the browser already has it
+def conditional_page_response(page):
+    response = make_response(page['html'])
+    response.set_etag(page['etag'])
+    response.last_modified = page['last_modified']
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+# Function to convert a report DataFrame into the HTML table shown on result.html
+def render_report_table(df):
+    with metrics.timer('costs_render_seconds', 'Time spent rendering report HTML', step='table'):
+        html_table = format_report_columns(df).to_html(classes='data', index=False)
+    # Rename the column headers
+    return html_table.replace('<th>PreTaxCost</th>', '<th>Cost:</th>')
+
+# Function to stream a large report page, emitting the table rows in chunks instead of one multi-megabyte string
+def stream_report_page(filename, df, last_update, page_key, entry=None):
+    marker = '<!-- report-table -->'
+    page_head, page_tail = render_template('result.html', filename=filename, html_table=marker, last_update=last_update).split(marker)
+    table = render_report_table(df.iloc[:0])
+    split_at = table.index('<tbody>') + len('<tbody>')
+    table_head, table_tail = table[:split_at], table[split_at:]
+
+    def generate():
+        started = time.perf_counter()
+        chunks = []
+        for chunk in (page_head, table_head):
+            chunks.append(chunk)
+            yield chunk
+        for start in range(0, len(df), STREAM_CHUNK_ROWS):
+            rows = format_report_columns(df.iloc[start:start + STREAM_CHUNK_ROWS]).to_html(index=False, header=False)
+            chunk = rows[rows.index('<tbody>') + len('<tbody>'):rows.index('</tbody>')].rstrip()
+            chunks.append(chunk)
+            yield chunk
+        for chunk in (table_tail, page_tail):
+            chunks.append(chunk)
+            yield chunk
+        metrics.observe('costs_render_seconds', 'Time spent rendering report HTML', time.perf_counter() - started, step='stream')
+        # Later requests for the same snapshot are answered from the render cache
+        if entry:
+            store_rendered_page(page_key, entry, ''.join(chunks))
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+# Function to tag each request with an ID, taken from X-Request-ID when a proxy already assigned one
+@app.before_request
+def start_request_metrics():
+    # Workers not started through gunicorn.conf.py start the warmer on their first request
+    ensure_snapshot_warmer()
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+
+# Function to record the duration of each request and log it as one structured line
+@app.after_request
+def record_request_metrics(response):
+    # Streamed pages are timed until their first chunk, the stream itself is timed by stream_report_page
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('costs_http_request_seconds', 'Latency of dashboard requests by endpoint and status',
+                    elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+    logging.info(json.dumps({'event': 'request', 'method': request.method, 'path': request.path, 'endpoint': endpoint,
+                             'status': response.status_code, 'duration_ms': round(elapsed * 1000, 1)}))
+    return response
+
 @app.route('/')
 @app.route('/index')
 # @cache.cached()
 def index():
-    directory_path = 'body'  # Path to directory containing JSON files
-    filenames = os.listdir(directory_path)
-    categorized_filenames = categorize_filenames(filenames)
+    categorized_filenames = query_registry.get_categorized()
     return render_template('index.html', categorized_filenames=categorized_filenames, reservation_cost=reservation_cost)
 
 @app.route('/<filename>')
@@ -289,220 +2018,553 @@ def display_result(filename):
     if filename.endswith('.json'):
         filename = filename[:-5]  # Remove last 5 characters (.json)
 
-    directory_path = 'body'
+    # Large reports show their first page and page through /api/reports, ?all=true renders every row and so does
+    # ?stream=true, which streams them
+    stream = request.args.get('stream', '').lower()
+    show_all = request.args.get('all', '').lower() == 'true' or stream == 'true'
+    page_key = f"{filename}?all" if show_all else filename
+
+    # Serve from the latest snapshot when the warmer already has this report
+    entry = get_snapshot_report(filename)
+    if entry:
+        page = get_rendered_page(page_key, entry['version'])
+        if page:
+            return conditional_page_response(page)
+        df, entry = get_report_dataframe(filename)
+        last_update = format_refreshed_at(entry['refreshed_at'])
+    else:
+        json_data = query_registry.payload(filename)
 
-    # Construct the JSON file path
-    json_file = os.path.join(directory_path, filename + '.json')
+        # Check if the query exists
+        if json_data is None:
+            abort(404)
 
-    # Check if the JSON file exists
-    if os.path.exists(json_file):
-        # Load JSON data from the file
-        with open(json_file, 'r') as f:
-            json_data = json.load(f)
+        current_query.set(filename)
 
-        # Adjust time parameter for files containing 'ytd'
-        if 'ytd' in filename:
-            to_time = datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
-            json_data['timePeriod']['to'] = to_time
+        # Make POST request using the adjusted scope, loaded JSON data, and time parameter
+        df = make_post_request(scope, json_data)
+        if df is not None:
+            df = prepare_report_dataframe(df)
+        last_update = format_refreshed_at(datetime.now(pytz.utc))
+
+    if df is not None:
+        paged = not show_all and len(df) > REPORT_PAGE_SIZE
+
+        # Stream very large reports so the browser can start rendering rows right away
+        if not paged and (stream == 'true' or (stream != 'false' and len(df) > STREAM_ROW_THRESHOLD)):
+            return stream_report_page(filename, df, last_update, page_key, entry)
+
+        # Render the template with the HTML table and the time the data was refreshed
+        html_table = render_report_table(df.iloc[:REPORT_PAGE_SIZE] if paged else df)
+        html = render_template('result.html', filename=filename, html_table=html_table, last_update=last_update,
+                               paged=paged, total_rows=len(df), page_size=REPORT_PAGE_SIZE)
+        if entry:
+            return conditional_page_response(store_rendered_page(page_key, entry, html))
+        return html
+    else:
+        return f"No data retrieved for {filename}"
+
+# Function to convert DataFrame rows to JSON friendly lists, costs stay numeric and missing values become null
+def dataframe_rows(df):
+    df = format_date_columns(df)
+    return df.astype(object).where(df.notna(), None).values.tolist()
+
+# Download formats of /export, with their content type
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file'
+}
+
+# Function to give a report DataFrame plain column names for export
+def export_dataframe(df):
+    return df.rename(columns=lambda col: 'Cost' if col == 'PreTaxCost' else col.rstrip(':'))
+
+# Write-only file handed to pyarrow writers, the bytes written so far are drained after every chunk
+class ExportBuffer(io.RawIOBase):
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        written = self.buffer.write(data)
+        self.position += written
+        return written
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
 
-        # Get the current date and time
-        current_time = datetime.now()
+# Function to yield a report as CSV, EXPORT_CHUNK_ROWS rows at a time
+def generate_csv_export(df):
+    for start in range(0, max(len(df), 1), EXPORT_CHUNK_ROWS):
+        yield df.iloc[start:start + EXPORT_CHUNK_ROWS].to_csv(index=False, header=start == 0, date_format='%Y-%m-%d')
+
+# Function to yield a report as Parquet (one row group per chunk) or an Arrow IPC file (one record batch per chunk)
+def generate_columnar_export(df, export_format, pa, pq):
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    sink = ExportBuffer()
+    writer = pq.ParquetWriter(sink, schema) if export_format == 'parquet' else pa.ipc.new_file(sink, schema)
+    with writer:
+        for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+            writer.write_table(pa.Table.from_pandas(df.iloc[start:start + EXPORT_CHUNK_ROWS], schema=schema, preserve_index=False))
+            yield sink.drain()
+    # Footer written on close
+    yield sink.drain()
+
+@app.route('/export/<filename>.<export_format>')
+def export_report(filename, export_format):
+    if export_format not in EXPORT_FORMATS or filename not in query_registry:
+        abort(404)
 
-        # Calculate the start time for yesterday
-        start_of_yesterday = (current_time - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-        from_time = start_of_yesterday.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if export_format == 'csv':
+        generate = generate_csv_export
+    else:
+        # pyarrow is optional, only the columnar downloads need it
+        try:
+            import pyarrow as pa
+            import pyarrow.ipc
+            import pyarrow.parquet as pq
+        except ImportError:
+            return jsonify({"error": f"{export_format} export requires the pyarrow package"}), 501
+        generate = lambda df: generate_columnar_export(df, export_format, pa, pq)
+
+    df, entry = get_report_dataframe(filename)
+    if df is None:
+        return jsonify({"error": f"No data retrieved for {filename}"}), 502
+
+    response = Response(stream_with_context(generate(export_dataframe(df))), mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{export_format}"'
+    if entry:
+        response.headers['X-Last-Refreshed'] = entry['refreshed_at'].isoformat()
+    return response
+
+# Function to read an integer query argument of at least minimum, raises ValueError for anything else
+def int_arg(name, default, minimum=1):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < minimum:
+        raise ValueError(f"{name} must be an integer of at least {minimum}")
+    return number
+
+@app.route('/api/reports/<filename>')
+def display_report_data_api(filename):
+    if filename not in query_registry:
+        abort(404)
 
-        # Calculate the end time for yesterday
-        end_of_yesterday = (current_time - timedelta(days=1)).replace(hour=23, minute=59, second=59, microsecond=999999)
-        to_time = end_of_yesterday.strftime('%Y-%m-%dT%H:%M:%SZ')
+    df, entry = get_report_dataframe(filename)
+    if df is None:
+        return jsonify({"error": f"No data retrieved for {filename}"}), 502
 
-        if 'yesterday' in filename:
-            json_data['timePeriod']['from']= from_time
-            json_data['timePeriod']['to'] = to_time
+    try:
+        limit = min(int_arg('limit', REPORT_PAGE_SIZE), REPORT_MAX_PAGE_SIZE)
+        offset = int_arg('offset', 0, minimum=0)
+        top = int_arg('top', None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Filter by dimension value, optionally restricted to one column (owner, subscription, resource group...)
+    filter_value = request.args.get('filter', '').strip()
+    if filter_value:
+        if request.args.get('column'):
+            column = resolve_report_column(df, request.args['column'])
+            if column is None:
+                return jsonify({"error": f"Unknown column: {request.args['column']}"}), 400
+            filter_columns = [column]
+        else:
+            filter_columns = list(df.select_dtypes(include=['object', 'category']).columns)
+        mask = pd.Series(False, index=df.index)
+        for col in filter_columns:
+            mask |= distinct_value_mask(df[col], lambda values: values.str.contains(filter_value, case=False, regex=False))
+        df = df[mask]
+
+    # Top-N by cost, otherwise sort by the requested column
+    if top is not None and 'PreTaxCost' in df.columns:
+        df = df.sort_values('PreTaxCost', ascending=False).head(top)
+    elif request.args.get('sort'):
+        column = resolve_report_column(df, request.args['sort'])
+        if column is None:
+            return jsonify({"error": f"Unknown column: {request.args['sort']}"}), 400
+        df = df.sort_values(column, ascending=request.args.get('order', 'asc').lower() != 'desc', kind='stable')
+
+    page = df.iloc[offset:offset + limit]
+    return jsonify({
+        'report': filename,
+        'columns': list(df.columns),
+        'rows': dataframe_rows(page),
+        'total_rows': len(df),
+        'total_cost': float(df['PreTaxCost'].sum()) if 'PreTaxCost' in df.columns else None,
+        'offset': offset,
+        'limit': limit,
+        'last_refreshed': entry['refreshed_at'].isoformat() if entry else None
+    })
+
+@app.route('/consolidated/<filename>')
+def display_consolidated_result(filename):
+    if filename not in query_registry:
+        abort(404)
+    query_scopes = requested_scopes()
+    if not query_scopes:
+        abort(404)
 
-        # Make POST request using the adjusted scope, loaded JSON data, and time parameter
-        df = make_post_request(scope, json_data)
+    # Scopes are queried in a background job, the page reloads itself until the job has finished
+    job = submit_consolidated_query(filename, query_scopes)
+    job['done'].wait(requested_wait(JOB_INLINE_WAIT))
+    if job['status'] == 'failed':
+        return f"No data retrieved for {filename}"
+    if job['status'] != 'done':
+        response = make_response(f"Querying {len(query_scopes)} scopes for {filename}, this page reloads when they are done.", 202)
+        response.headers['Refresh'] = str(JOB_POLL_INTERVAL)
+        response.headers['Retry-After'] = str(JOB_POLL_INTERVAL)
+        return response
+
+    consolidated = job['result'][0]
+    df = pd.DataFrame(consolidated['rows'], columns=consolidated['columns'])
+    totals = pd.DataFrame(consolidated['totals']['rows'], columns=consolidated['totals']['columns'])
+    return render_template('result.html', filename=filename, html_table=render_report_table(df),
+                           totals_table=render_report_table(totals), scope_count=len(query_scopes),
+                           failed_scopes=[scope_label(query_scope) for query_scope in consolidated['errors']],
+                           last_update=format_refreshed_at(datetime.fromisoformat(consolidated['refreshed_at'])))
+
+@app.route('/api/consolidated/<filename>')
+def display_consolidated_result_api(filename):
+    if filename not in query_registry:
+        abort(404)
+    query_scopes = requested_scopes()
+    if not query_scopes:
+        return jsonify({"error": "None of the requested scopes is configured"}), 400
+
+    # Fan out in a background job so throttled scopes never hold this worker, slow consolidations are polled
+    job = submit_consolidated_query(filename, query_scopes)
+    return job_response(job, requested_wait(JOB_INLINE_WAIT))
+
+@app.route('/api/forecast/<dimension>')
+def get_dimension_forecast(dimension):
+    filename = query_registry.find('daily', dimension)
+    if filename is None:
+        abort(404)
+    # Only the history scored by the snapshot refresh is read, the forecast never queries Azure or the cost store
+    forecasts = forecast_report(filename)
+    if forecasts is None:
+        return jsonify({"error": f"Not enough daily history for {filename} yet, at least {FORECAST_MIN_DAYS} complete days "
+                                 f"from the snapshot refresh are needed"}), 503
+
+    return jsonify({
+        'dimension': dimension,
+        'report': filename,
+        'interval': FORECAST_INTERVAL,
+        **{period: {**{key: value for key, value in forecast.items() if key != 'groups'},
+                    'total': {key: round(float(value), 2) for key, value in forecast['total'].items()},
+                    'groups': [{'group': group, **{key: round(value, 2) for key, value in values.items()}}
+                               for group, values in forecast['groups'].to_dict('index').items()]} if forecast else None
+           for period, forecast in forecasts.items()}
+    })
+
+@app.route('/api/anomalies')
+def get_anomalies():
+    reports = [name.strip() for name in request.args.get('report', '').split(',') if name.strip()]
+    if any(name not in query_registry.names(period='daily') for name in reports):
+        return jsonify({"error": "report must be a comma separated list of daily-* reports"}), 400
+    try:
+        days = int_arg('days', ANOMALY_LOOKBACK_DAYS)
+        limit = min(int_arg('limit', REPORT_PAGE_SIZE), REPORT_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Only the state scored by the snapshot refresh is read, reports not refreshed yet have no anomalies
+    with anomaly_detector.lock:
+        states = {name: state for name, state in anomaly_detector.reports.items() if not reports or name in reports}
+
+    frames = [state['anomalies'].assign(report=name) for name, state in states.items() if len(state['anomalies'])]
+    if frames:
+        anomalies = pd.concat(frames, ignore_index=True)
+        latest_day = max(state['history'].columns[-1] for state in states.values())
+        anomalies = anomalies[anomalies['date'] > latest_day - pd.Timedelta(days=days)]
+        anomalies = anomalies.sort_values(['date', 'zscore'], ascending=False).head(limit)
+    else:
+        anomalies = pd.DataFrame(columns=['report', 'group', 'date', 'cost', 'expected', 'previous_day', 'zscore'])
+
+    return jsonify({
+        'anomalies': [{'report': row.report, 'group': row.group, 'date': f"{row.date:%Y-%m-%d}", 'cost': round(row.cost, 2),
+                       'expected': round(row.expected, 2), 'previous_day': round(row.previous_day, 2), 'zscore': round(row.zscore, 1)}
+                      for row in anomalies.itertuples(index=False)],
+        'reports': anomaly_detector.status()
+    })
+
+# Report periods that can be compared with each other, forecast has no per-dimension reports
+COMPARE_PERIODS = [period for period, query in QUERY_PERIODS.items() if query]
+# Dimensions offered as the next level when drilling down from a comparison
+DRILL_DOWN_DIMENSIONS = ['category', 'resource-type', 'resource-groups']
+# Label of costs without a value for the compared dimension (e.g. resources missing the tag)
+UNTAGGED_LABEL = '(untagged)'
+
+# Function to return the report frame of a report with every row kept, for comparisons that must add up to the grand
+# totals, and its snapshot entry (None when queried live)
+def get_comparison_dataframe(filename):
+    entry = get_snapshot_report(filename)
+    if entry:
+        result = entry['result']
+    else:
+        result, error, status_code = run_result_query(filename)
+        if result is None:
+            return None, None
+    return clean_report_dataframe(result['frame'], display_filters=False), entry
+
+# Function to sum a report's costs per dimension value, daily reports are summed over their usage dates and blank
+# values are summed as UNTAGGED_LABEL
+def report_cost_totals(df):
+    keys = [col for col in df.columns if col != 'PreTaxCost' and not pd.api.types.is_datetime64_any_dtype(df[col])]
+    if not keys:
+        return pd.DataFrame({'Total:': ['Total'], 'PreTaxCost': [df['PreTaxCost'].sum()]}), ['Total:']
+    df = df[keys + ['PreTaxCost']].copy()
+    for col in keys:
+        blank = df[col].isna().to_numpy() | distinct_value_mask(df[col], lambda values: values.str.strip() == '')
+        df[col] = df[col].astype(object).where(~blank, UNTAGGED_LABEL)
+    totals = df.groupby(keys, observed=True, dropna=False)['PreTaxCost'].sum().reset_index()
+    # Each report has its own categories, join on the plain values
+    return totals.astype({col: object for col in keys}), keys
+
+# Function to join the per-value costs of two reports, returns rows ordered by the size of the change (None if the reports are not comparable)
+def compare_reports(current_df, previous_df):
+    current, keys = report_cost_totals(current_df)
+    previous, previous_keys = report_cost_totals(previous_df)
+    if keys != previous_keys:
+        return None
 
-        # Calculate total cost and total of all columns
-        if df is not None:
-            # Calculate sum of each column containing costs
-            cost_columns = [col for col in df.columns if 'Cost' in col]
-            for col in cost_columns:
-                df[col] = df[col].replace('[$,]', '', regex=True).astype(float)
-                # total_row = {col: '${:,.2f}'.format(df[col].sum()) for col in cost_columns}
-    
-            # Calculate total of all numeric columns
-            numeric_columns = df.select_dtypes(include=['float64', 'int64']).columns
-            for col in numeric_columns:
-                # Convert to numeric, handling non-numeric values gracefully
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-
-            # Apply formatting only to numeric values
-            for col in numeric_columns:
-                df[col] = df[col].apply(lambda x: '${:,.2f}'.format(x) if pd.notna(x) else '')
-
-            # total_df = pd.DataFrame(total_row, index=['Total'])
-            df = pd.concat([df])
-            #total_df
-
-            df = remove_rows_with_zero(df)
-            df = remove_rows_with_empty_cells(df)
-
-            # Convert df to HTML table
-            html_table = df.to_html(classes='data', index=False)
-            # Rename the column headers
-            html_table = html_table.replace('<th>PreTaxCost</th>', '<th>Cost:</th>')
-            
-            # Get the current date and time
-            desired_timezone = pytz.timezone('America/Los_Angeles')
-            current_datetime = datetime.now(desired_timezone).strftime("%B %d, %Y %H:%M:%S")
-            
-            # Render the template with the HTML table and current date and time
-            return render_template('result.html', filename=filename, html_table=html_table, last_update=current_datetime)
+    # Values missing from one period cost nothing in it
+    comparison = current.merge(previous, on=keys, how='outer', suffixes=('_current', '_previous'))
+    comparison = comparison.rename(columns={'PreTaxCost_current': 'current', 'PreTaxCost_previous': 'previous'})
+    comparison[['current', 'previous']] = comparison[['current', 'previous']].fillna(0.0)
+    comparison['delta'] = comparison['current'] - comparison['previous']
+    previous_costs = comparison['previous'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        comparison['change_pct'] = np.where(previous_costs != 0, comparison['delta'].to_numpy() / np.abs(previous_costs) * 100, np.nan)
+    comparison = comparison.round({'current': 2, 'previous': 2, 'delta': 2, 'change_pct': 1})
+    return comparison.sort_values('delta', key=lambda delta: delta.abs(), ascending=False, kind='stable').reset_index(drop=True)
+
+# Function to summarize one side of a comparison
+def compare_side(period, filename, df, entry):
+    return {
+        'period': period,
+        'report': filename,
+        'total': round(float(df['PreTaxCost'].sum()), 2),
+        'last_refreshed': entry['refreshed_at'].isoformat() if entry else None
+    }
+
+@app.route('/compare')
+def display_comparison():
+    dimensions = sorted({query_registry.get(name)['dimension'] for name in query_registry.names(period='mtd')})
+    return render_template('compare.html', dimensions=dimensions, periods=COMPARE_PERIODS, drill_down=DRILL_DOWN_DIMENSIONS)
+
+@app.route('/api/compare')
+def get_comparison():
+    dimension = request.args.get('dimension', 'category')
+    current_period = request.args.get('current', 'mtd')
+    previous_period = request.args.get('previous', 'last-month')
+    if current_period not in COMPARE_PERIODS or previous_period not in COMPARE_PERIODS:
+        return jsonify({"error": f"current and previous must be one of {', '.join(COMPARE_PERIODS)}"}), 400
+    try:
+        limit = min(int_arg('limit', REPORT_PAGE_SIZE), REPORT_MAX_PAGE_SIZE)
+        movers = min(int_arg('movers', 5), REPORT_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    filenames = [query_registry.find(current_period, dimension), query_registry.find(previous_period, dimension)]
+    if None in filenames:
+        return jsonify({"error": f"No {current_period} and {previous_period} reports for {dimension}"}), 404
+
+    # Both reports come from the snapshot when it has them, otherwise they are queried side by side
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        (current_df, current_entry), (previous_df, previous_entry) = executor.map(get_comparison_dataframe, filenames)
+    if current_df is None or previous_df is None:
+        missing = [name for name, df in zip(filenames, (current_df, previous_df)) if df is None]
+        return jsonify({"error": f"No data retrieved for {', '.join(missing)}"}), 502
+
+    comparison = compare_reports(current_df, previous_df)
+    if comparison is None:
+        return jsonify({"error": f"{filenames[0]} and {filenames[1]} are not grouped the same way"}), 400
+
+    current = compare_side(current_period, filenames[0], current_df, current_entry)
+    previous = compare_side(previous_period, filenames[1], previous_df, previous_entry)
+    delta = round(current['total'] - previous['total'], 2)
+    increases = comparison[comparison['delta'] > 0].nlargest(movers, 'delta')
+    decreases = comparison[comparison['delta'] < 0].nsmallest(movers, 'delta')
+    return jsonify({
+        'dimension': dimension,
+        'current': current,
+        'previous': previous,
+        'delta': delta,
+        'change_pct': round(delta / abs(previous['total']) * 100, 1) if previous['total'] else None,
+        'columns': list(comparison.columns),
+        'rows': dataframe_rows(comparison.head(limit)),
+        'total_rows': len(comparison),
+        'top_increases': dataframe_rows(increases),
+        'top_decreases': dataframe_rows(decreases)
+    })
+
+@app.route('/api/snapshot')
+def get_snapshot_status():
+    with snapshot_lock:
+        current = snapshot
+    return jsonify({
+        'version': current['version'],
+        'refreshed_at': current['refreshed_at'].isoformat() if current['refreshed_at'] else None,
+        'reports': {name: entry['refreshed_at'].isoformat() for name, entry in current['reports'].items()}
+    })
+
+@app.route('/api/memory')
+def get_report_memory_status():
+    with snapshot_lock:
+        reports = {name: entry['memory'] for name, entry in snapshot['reports'].items()}
+    # Every snapshot report holds its result rows and its processed DataFrame
+    result_bytes = sum(memory['result']['bytes'] for memory in reports.values())
+    processed_bytes = sum(memory['processed']['bytes'] for memory in reports.values())
+    return jsonify({'reports': reports, 'result_bytes': result_bytes, 'processed_bytes': processed_bytes,
+                    'total_bytes': result_bytes + processed_bytes})
+
+@app.route('/api/cache')
+def get_result_cache_status():
+    return jsonify(result_cache.status())
+
+@app.route('/api/cost-store')
+def get_cost_store_status():
+    if not cost_store:
+        return jsonify({"message": "cost store disabled, set COST_STORE_ENABLED=true"}), 200
+    return jsonify(cost_store.status())
+
+@app.route('/api/scheduler')
+def get_scheduler_status():
+    return jsonify(scheduler.status())
+
+@app.route('/metrics')
+def get_metrics():
+    status = scheduler.status()
+    with snapshot_lock:
+        version, refreshed_at = snapshot['version'], snapshot['refreshed_at']
+        memory = [entry['memory'] for entry in snapshot['reports'].values()]
+    result_bytes = sum(report['result']['bytes'] for report in memory)
+    processed_bytes = sum(report['processed']['bytes'] for report in memory)
+    gauges = {
+        'costs_scheduler_queue_depth': ('Azure API calls waiting for the request scheduler', status['queue_depth']),
+        'costs_scheduler_in_flight': ('Azure API calls currently executing', status['in_flight']),
+        'costs_scheduler_throttled_seconds': ('Seconds until the global throttle pause ends', status['throttled_for_seconds']),
+        'costs_snapshot_version': ('Version of the latest snapshot', version),
+        'costs_snapshot_result_bytes': ('Memory held by the query results of the snapshot reports', result_bytes),
+        'costs_processed_reports_bytes': ('Memory held by the processed report DataFrames', processed_bytes),
+        'costs_snapshot_age_seconds': ('Seconds since the latest snapshot was refreshed',
+                                       round((datetime.now(pytz.utc) - refreshed_at).total_seconds(), 3) if refreshed_at else -1)
+    }
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/batch')
+def display_result_batch_api():
+    filenames = [name.strip() for name in request.args.get('q', '').split(',') if name.strip()]
+    if not filenames:
+        return jsonify({"error": "Provide a comma separated list of queries, e.g. ?q=mtd-team,mtd-env"}), 400
+
+    results = {}
+    errors = {}
+    jobs = {}
+    for filename in dict.fromkeys(filenames):
+        # Serve warmed reports from the snapshot and only query the rest, in background jobs
+        entry = get_snapshot_report(filename)
+        if entry:
+            results[filename] = result_response(entry['result'])
+        elif filename not in query_registry:
+            errors[filename] = {"error": f"Unknown query: {filename}", "status": 404}
         else:
-            return f"No data retrieved for {filename}"
-    else:
-        abort(404)
+            jobs[filename] = query_jobs.submit(f"query/{filename}", run_query, filename)
+
+    # Wait a little for the jobs, reports still running are returned as job URLs to poll
+    deadline = time.time() + requested_wait(JOB_INLINE_WAIT)
+    pending = {}
+    for filename, job in jobs.items():
+        job['done'].wait(max(0.0, deadline - time.time()))
+        response, error, status_code = job['result'] or (None, None, None)
+        if job['status'] == 'done':
+            results[filename] = response
+        elif job['status'] == 'failed':
+            errors[filename] = {"error": error, "status": status_code}
+        else:
+            pending[filename] = job_poll_url(job)
+
+    return jsonify({"results": results, "errors": errors, "pending": pending}), 202 if pending else 200
 
 @app.route('/api/consumption')
-@cache.cached()
+@cache.cached(response_filter=is_complete_response)
 def get_consumption_data():
     fetch_data = os.getenv('FETCH_CONSUMPTION_DATA', 'false').lower() == 'true'
 
     if not fetch_data:
         return jsonify({"message": "macc_status: fetch_data"}), 200
 
-    retry_limit = 100
+    # Retries and throttling are handled by the request scheduler on a job thread
+    job = query_jobs.submit('consumption', run_consumption_query, job_id=request.args.get('job'))
+    return job_response(job, requested_wait(JOB_INLINE_WAIT))
+
+@app.route('/api/jobs')
+def get_job_status():
+    return jsonify(query_jobs.status())
+
+@app.route('/api/jobs/<job_id>')
+def get_job_result(job_id):
+    job = query_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown or expired job: {job_id}"}), 404
+    return job_response(job, requested_wait(0))
+
+# Function to return a snapshot entry as JSON with its last refreshed timestamp
+def snapshot_response(entry):
+    response = jsonify(result_response(entry['result']))
+    response.headers['X-Last-Refreshed'] = entry['refreshed_at'].isoformat()
+    return response
+
+# Function to answer an API request from the snapshot, falling back to a live query
+def serve_query_api(filename):
+    # Serve from the latest snapshot when the warmer already has this report
+    entry = get_snapshot_report(filename)
+    if entry:
+        return snapshot_response(entry)
 
-    for attempt in range(retry_limit):
-        consumption_data = fetch_consumption_data()
-        if consumption_data:
-            return jsonify(consumption_data['value'])
-        else:
-            print(f"Attempt {attempt + 1} failed to fetch MACC Balance")
-            if attempt < retry_limit - 1:
-                time.sleep(70)
-                
-    return jsonify({"error": "Failed to fetch consumption data"}), 500
+    # Check if the JSON file exists
+    if filename not in query_registry:
+        abort(404)
+
+    # Query in a background job so a throttled Azure call never holds this worker, slow queries are polled
+    job = query_jobs.submit(f"query/{filename}", run_query, filename, job_id=request.args.get('job'))
+    return job_response(job, requested_wait(JOB_INLINE_WAIT))
 
 @app.route('/api/<filename>')
 @app.route('/api/<filename>.json')
-@cache.cached()
+@cache.cached(key_prefix=snapshot_cache_key, response_filter=is_complete_response)
 def display_result_api(filename):
     # Remove .json extension if present
     if filename.endswith('.json'):
         filename = filename[:-5]  # Remove last 5 characters (.json)
 
-    directory_path = 'body'
-
-    # Construct the JSON file path
-    json_file = os.path.join(directory_path, filename + '.json')
-
-    # Check if the JSON file exists
-    if os.path.exists(json_file):
-        # Load JSON data from the file
-        with open(json_file, 'r') as f:
-            json_data = json.load(f)
-
-        # Adjust time parameter for files containing 'ytd'
-        if 'ytd' in filename:
-            to_time = datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
-            json_data['timePeriod']['to'] = to_time
-
-        # Get the current date and time
-        current_time = datetime.now()
-
-        # Calculate the start time for yesterday
-        start_of_yesterday = (current_time - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-        from_time = start_of_yesterday.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-        # Calculate the end time for yesterday
-        end_of_yesterday = (current_time - timedelta(days=1)).replace(hour=23, minute=59, second=59, microsecond=999999)
-        to_time = end_of_yesterday.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-        if 'yesterday' in filename:
-            json_data['timePeriod']['from']= from_time
-            json_data['timePeriod']['to'] = to_time
-        
-        # Calculate the start of the month
-        start_of_month = current_time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        from_time = start_of_month.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-        # Calculate the end of the month by finding the start of the next month, then subtracting a microsecond
-        next_month = start_of_month.replace(month=start_of_month.month % 12 + 1)
-        if start_of_month.month == 12:  # Handle December to January transition
-            next_month = next_month.replace(year=start_of_month.year + 1)
-        end_of_month = next_month - timedelta(microseconds=1)
-        to_time = end_of_month.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'  # Truncate microseconds to 3 places
-
-        if 'forecast' in filename:
-            json_data['timePeriod']['from']= from_time
-            json_data['timePeriod']['to'] = to_time
-
-                
-        retry_limit = 100
-
-        for attempt in range(retry_limit):
-            response, error, status_code = make_post_request_api(scope, json_data)
-            if response:
-                return jsonify(response)
-            else:
-                print(f"Attempt {attempt + 1} failed: {error}")
-                if attempt < retry_limit - 1:
-                    time.sleep(70)
-    
-        return jsonify({"error": error}), status_code if status_code else 500
+    return serve_query_api(filename)
 
 @app.route('/api/forecast')
 @app.route('/api/forecast.json')
-@cache.cached()
+@cache.cached(key_prefix=snapshot_cache_key, response_filter=is_complete_response)
 def display_result_forecast_api():
-    # Remove .json extension if present
-    filename = 'forecast.json'
-    if filename.endswith('.json'):
-        filename = filename[:-5]  # Remove last 5 characters (.json)
-
-    directory_path = 'body/forecast'
+    return serve_query_api('forecast')
 
-    # Construct the JSON file path
-    json_file = os.path.join(directory_path + '.json')
-
-    # Check if the JSON file exists
-    if os.path.exists(json_file):
-        # Load JSON data from the file
-        with open(json_file, 'r') as f:
-            json_data = json.load(f)
-
-        # Get the current date and time
-        current_time = datetime.now()
-       
-        # Calculate the start of the month
-        start_of_month = current_time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        from_time_f = start_of_month.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-        # Calculate the end of the month by finding the start of the next month, then subtracting a microsecond
-        next_month = start_of_month.replace(month=start_of_month.month % 12 + 1)
-        if start_of_month.month == 12:  # Handle December to January transition
-            next_month = next_month.replace(year=start_of_month.year + 1)
-        end_of_month = next_month - timedelta(microseconds=1)
-        to_time_f = end_of_month.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'  # Truncate microseconds to 3 places
-
-        json_data['timePeriod']['from']= from_time_f
-        json_data['timePeriod']['to'] = to_time_f
-
-                
-        retry_limit = 100
-
-        for attempt in range(retry_limit):
-            response, error, status_code = make_post_request_forecast_api(scope, json_data, from_time_f, to_time_f)
-            if response:
-                return jsonify(response)
-            else:
-                print(f"Attempt {attempt + 1} failed: {error}")
-                if attempt < retry_limit - 1:
-                    time.sleep(70)
-    
-        return jsonify({"error": error}), status_code if status_code else 500
-    
 if __name__ == '__main__':
+    # The debug reloader runs this file in a watcher process that never serves requests, only its child starts the warmer
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        ensure_snapshot_warmer()
     app.run(debug=True)
@@ -0,0 +1,108 @@
+# Benchmark of the report DataFrame pipeline on a synthetic Cost Management response.
+#
+# Compares the original string-based pipeline (per-cell apply, '$' formatting before filtering)
+# with the pipeline app.py runs (result pages -> compact result frame -> report frame), and checks both
+# produce the same rendered rows.
+#
+# Usage: python bench/bench_pipeline.py [--rows 500000] [--page-size 5000] [--repeat 3]
+import argparse
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('SCOPE', 'providers/Microsoft.Billing/billingAccounts/benchmark')
+os.environ.setdefault('ENABLE_SNAPSHOT_WARMER', 'false')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+import app
+
+
+# Function to build a daily-resource-groups shaped response with the given number of rows
+def make_response(rows, seed=42):
+    rng = random.Random(seed)
+    groups = [f"rg-{name}" for name in ('web', 'data', 'ml', 'ops', 'shared')] + [f"rgapp{i}" for i in range(2000)]
+    data = []
+    for i in range(rows):
+        cost = rng.choice([0.0, 0.001, -1.25, rng.uniform(0, 5000)])
+        data.append([cost, 20240101 + (i % 28), rng.choice(groups) if i % 50 else '', 'USD'])
+    return {'properties': {'columns': [{'name': 'PreTaxCost'}, {'name': 'UsageDate'}, {'name': 'ResourceGroup'}, {'name': 'Currency'}],
+                           'rows': data}}
+
+
+# The pipeline as it was before costs were kept numeric, kept here as the baseline
+def legacy_pipeline(response_json):
+    columns = [col['name'] for col in response_json['properties']['columns']]
+    df = pd.DataFrame(response_json['properties']['rows'], columns=columns)
+    df.drop(columns=['Currency'], inplace=True)
+    df = df[[col for col in df.columns if col != 'PreTaxCost'] + ['PreTaxCost']]
+    for col in df.columns:
+        if 'Cost' in col:
+            df[col] = df[col].apply(lambda x: '${:,.2f}'.format(float(x)))
+    df['UsageDate'] = pd.to_datetime(df['UsageDate'], format='%Y%m%d').dt.strftime('%B %d, %Y')
+    mask = df.apply(lambda x: x.astype(str).str.contains(r'-\d+', na=False)).any(axis=1)
+    df = df[~mask]
+    df = app.replace_column_names_with_keyword(df, 'UsageDate', 'Usage Date:')
+    df = app.replace_column_names_with_keyword(df, 'ResourceGroup', 'Resource Group:')
+
+    for col in [col for col in df.columns if 'Cost' in col]:
+        df[col] = df[col].replace('[$,]', '', regex=True).astype(float)
+    numeric_columns = df.select_dtypes(include=['float64', 'int64']).columns
+    for col in numeric_columns:
+        df[col] = df[col].apply(lambda x: '${:,.2f}'.format(x) if pd.notna(x) else '')
+    rows_to_drop = df[df.apply(lambda row: any(val.strip() == '$0.00' for val in row.values if isinstance(val, str)), axis=1)].index
+    df = df.drop(index=rows_to_drop)
+    rows_to_drop = df[df.apply(lambda row: any(pd.isnull(val) or (isinstance(val, str) and val.strip() == '') for val in row.values), axis=1)].index
+    return df.drop(rows_to_drop)
+
+
+# Function to split a response into nextLink pages the way the Cost Management API returns large results
+def split_pages(response_json, page_size):
+    rows = response_json['properties']['rows']
+    return [{'properties': {'columns': response_json['properties']['columns'], 'rows': rows[start:start + page_size]}}
+            for start in range(0, max(len(rows), 1), page_size)]
+
+
+# The pipeline the app runs for snapshot and live reports
+def current_pipeline(pages):
+    df = app.build_result_dataframe(app.result_frame_from_pages(pages))
+    df = app.prepare_report_dataframe(df)
+    return app.format_report_columns(df)
+
+
+def best_of(func, data, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(data)
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the report DataFrame pipeline')
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--page-size', type=int, default=5000, help='rows per result page')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    response_json = make_response(args.rows)
+    legacy_seconds, legacy_df = best_of(legacy_pipeline, response_json, args.repeat)
+    current_seconds, current_df = best_of(current_pipeline, split_pages(response_json, args.page_size), args.repeat)
+
+    # Dimension columns are categorical in the current pipeline, compare the displayed values
+    if not legacy_df.reset_index(drop=True).equals(current_df.reset_index(drop=True).astype(object)):
+        print("Mismatch between legacy and vectorized pipeline output")
+        return 1
+
+    print(f"rows in: {args.rows:,}  rows out: {len(current_df):,}")
+    print(f"legacy:     {legacy_seconds:8.2f}s")
+    print(f"vectorized: {current_seconds:8.2f}s")
+    print(f"speedup:    {legacy_seconds / current_seconds:8.1f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+# Local stand-in for the Azure Cost Management and Consumption endpoints used by app.py.
+#
+# Serves /providers/Microsoft.CostManagement/query, /forecast and Microsoft.Consumption/lots for any scope,
+# with configurable latency, HTTP 429 injection, nextLink paging and result size.
+#
+# Usage: python bench/mock_azure.py --port 8081 --rows 5000 --page-size 1000 --latency 0.2 --throttle-rate 0.1
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+DIMENSION_VALUES = 50
+
+
+class MockConfig:
+    def __init__(self, rows=1000, page_size=5000, latency=0.0, throttle_rate=0.0, retry_after=1, seed=42):
+        self.rows = rows
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'throttled': 0, 'pages': 0}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def should_throttle(self):
+        with self.lock:
+            return self.random.random() < self.throttle_rate
+
+
+# Function to build the columns of a query response for the payload's granularity and grouping
+def query_columns(payload):
+    dataset = payload.get('dataset', {})
+    columns = [{'name': 'PreTaxCost', 'type': 'Number'}]
+    if dataset.get('granularity') == 'Daily':
+        columns.append({'name': 'UsageDate', 'type': 'Number'})
+    for group in dataset.get('grouping') or []:
+        if group['type'] == 'TagKey':
+            columns += [{'name': 'TagKey', 'type': 'String'}, {'name': 'TagValue', 'type': 'String'}]
+        else:
+            columns.append({'name': group['name'], 'type': 'String'})
+    columns.append({'name': 'Currency', 'type': 'String'})
+    return columns
+
+
+# Function to build the rows [start, end) of a query result, deterministic for a given index
+def query_rows(payload, start, end):
+    dataset = payload.get('dataset', {})
+    grouping = dataset.get('grouping') or []
+    first_day = datetime.now().replace(day=1)
+    rows = []
+    for index in range(start, end):
+        row = [round((index * 7919 % 100000) / 100.0, 4)]
+        if dataset.get('granularity') == 'Daily':
+            row.append(int((first_day + timedelta(days=index % 28)).strftime('%Y%m%d')))
+        for group in grouping:
+            value = f"{group['name']}{index % DIMENSION_VALUES}"
+            row += [group['name'], value] if group['type'] == 'TagKey' else [value]
+        row.append('USD')
+        rows.append(row)
+    return rows
+
+
+class MockAzureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = MockConfig()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        config = self.config
+        config.count('requests')
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+        if config.latency:
+            time.sleep(config.latency)
+
+        if config.should_throttle():
+            config.count('throttled')
+            retry_after = str(config.retry_after)
+            self._send_json(429, {'error': {'code': '429', 'message': 'Too many requests. Please retry.'}},
+                            {'Retry-After': retry_after, 'x-ms-ratelimit-microsoft.costmanagement-entity-retry-after': retry_after})
+            return
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path.endswith('/providers/Microsoft.CostManagement/query'):
+            self._send_query_page(url, query, payload)
+        elif url.path.endswith('/providers/Microsoft.CostManagement/forecast'):
+            self._send_json(200, {'properties': {
+                'columns': [{'name': 'Cost', 'type': 'Number'}, {'name': 'CostStatus', 'type': 'String'}, {'name': 'Currency', 'type': 'String'}],
+                'rows': [[12345.67, 'Actual', 'USD'], [6789.01, 'Forecast', 'USD']],
+                'nextLink': None}})
+        elif url.path.endswith('/providers/Microsoft.Consumption/lots'):
+            self._send_json(200, {'value': [{'properties': {'closedBalance': {'value': 250000.0}}}]})
+        else:
+            self._send_json(404, {'error': {'code': 'NotFound', 'message': f"No mock for {url.path}"}})
+
+    def _send_query_page(self, url, query, payload):
+        config = self.config
+        config.count('pages')
+        start = int(query.get('$skiptoken', ['0'])[0])
+        end = min(config.rows, start + config.page_size)
+        next_link = None
+        if end < config.rows:
+            params = {key: values[0] for key, values in query.items()}
+            params['$skiptoken'] = str(end)
+            next_link = f"http://{self.headers['Host']}{url.path}?{urlencode(params)}"
+        self._send_json(200, {'properties': {'columns': query_columns(payload), 'rows': query_rows(payload, start, end), 'nextLink': next_link}})
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+# Function to start the mock server on a background thread, returns the server (call shutdown() to stop it)
+def start_mock_server(port=0, **config):
+    handler = type('ConfiguredMockAzureHandler', (MockAzureHandler,), {'config': MockConfig(**config)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-azure', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock Azure Cost Management API')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--rows', type=int, default=1000, help='rows returned per query')
+    parser.add_argument('--page-size', type=int, default=5000, help='rows per page before a nextLink is returned')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests answered with HTTP 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with HTTP 429')
+    args = parser.parse_args()
+
+    server = start_mock_server(args.port, rows=args.rows, page_size=args.page_size, latency=args.latency,
+                               throttle_rate=args.throttle_rate, retry_after=args.retry_after)
+    print(f"Mock Azure API listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+# End-to-end benchmark of app.py against the local mock Azure API (bench/mock_azure.py).
+#
+# Starts the mock API in a subprocess and the dashboard on a local threaded server, then measures latency,
+# throughput and memory of /, /<report>, /api/<report> and /api/reports/<report> under concurrent load,
+# both before (cold) and after (warm) the snapshot is refreshed.
+#
+# Usage: python bench/run_bench.py --rows 20000 --page-size 5000 --latency 0.2 --throttle-rate 0.05 --concurrency 16
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_REPORTS = 'mtd-team,ytd-resource-groups,daily-resource-groups,yesterday-subscriptions,last-month-category'
+
+
+# Function to pick a free local port
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Function to wait until a local port accepts connections
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Port {port} did not open within {timeout}s")
+
+
+# Credential returning a static token, the mock API does not validate it
+class StaticCredential:
+    class Token:
+        token = 'benchmark'
+        expires_on = time.time() + 365 * 86400
+
+    def get_token(self, *scopes):
+        return self.Token()
+
+
+def start_mock_api(args):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bench', 'mock_azure.py'), '--port', str(port),
+                                '--rows', str(args.rows), '--page-size', str(args.page_size), '--latency', str(args.latency),
+                                '--throttle-rate', str(args.throttle_rate), '--retry-after', str(args.retry_after)],
+                               stdout=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process, port
+
+
+def start_dashboard(mock_port, args):
+    os.environ['SCOPE'] = 'providers/Microsoft.Billing/billingAccounts/benchmark'
+    os.environ['AZURE_MANAGEMENT_ENDPOINT'] = f"http://127.0.0.1:{mock_port}"
+    os.environ['ENABLE_SNAPSHOT_WARMER'] = 'false'
+    os.environ.setdefault('RESULT_CACHE_BACKEND', args.result_cache)
+    os.environ.setdefault('AZURE_BACKOFF_BASE', '0.2')
+    os.environ.setdefault('AZURE_BACKOFF_MAX', '5')
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+
+    import logging
+    import app as dashboard
+    from werkzeug.serving import make_server
+    logging.getLogger().setLevel(logging.ERROR)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    dashboard.azure_client.credential = StaticCredential()
+    port = free_port()
+    server = make_server('127.0.0.1', port, dashboard.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='dashboard', daemon=True).start()
+    return dashboard, server, port
+
+
+# Function to drop every cache, job and history of the dashboard so the next scenario starts cold, the result cache is
+# replaced by an empty one (a new SQLite file in cache_dir, or a new key prefix on Redis) instead of clearing shared state
+def reset_dashboard(dashboard, cache_dir):
+    dashboard.cache.clear()
+    with dashboard.snapshot_lock:
+        dashboard.snapshot = {'version': 0, 'refreshed_at': None, 'reports': {}}
+    with dashboard.rendered_pages_lock:
+        dashboard.rendered_pages.clear()
+
+    run_id = uuid.uuid4().hex
+    dashboard.RESULT_CACHE_PATH = os.path.join(cache_dir, f"results-{run_id}.sqlite")
+    result_cache = dashboard.create_result_cache()
+    if isinstance(result_cache, dashboard.RedisResultCache):
+        result_cache.prefix = f"costs:bench:{run_id}:"
+        result_cache.index = result_cache.prefix + 'lru'
+    dashboard.result_cache = result_cache
+
+    # Jobs of the previous scenario would otherwise be joined, finished ones answered from memory
+    dashboard.query_jobs.executor.shutdown(wait=False)
+    dashboard.query_jobs = dashboard.QueryJobs(dashboard.JOB_MAX_WORKERS, dashboard.JOB_RETENTION)
+    dashboard.anomaly_detector.restore({})
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+# Function to request the given paths with a fixed concurrency and summarize latency, throughput and memory
+def run_scenario(name, base_url, paths, total_requests, concurrency, trace_memory):
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def fetch(index):
+        path = paths[index % len(paths)]
+        started = time.perf_counter()
+        response = session.get(base_url + path)
+        polls = 0
+        # Follow 202 job responses to their result like the dashboard does, so latency covers the whole query
+        while response.status_code == 202:
+            polls += 1
+            time.sleep(float(response.headers.get('Retry-After', 1)))
+            response = session.get(base_url + response.headers['Location'])
+        _ = response.content
+        return time.perf_counter() - started, response.status_code, polls
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(fetch, range(total_requests)))
+    elapsed = time.perf_counter() - started
+    traced_peak = None
+    if trace_memory:
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies = [latency for latency, _, _ in results]
+    errors = sum(1 for _, status, _ in results if status >= 400)
+    return {
+        'scenario': name,
+        'requests': total_requests,
+        'errors': errors,
+        'job_polls': sum(polls for _, _, polls in results),
+        'throughput_rps': round(total_requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'max_ms': round(max(latencies) * 1000, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'traced_peak_mb': round(traced_peak / 1024 / 1024, 1) if traced_peak is not None else None
+    }
+
+
+def print_results(results):
+    columns = ['scenario', 'requests', 'errors', 'job_polls', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'peak_rss_mb', 'traced_peak_mb']
+    widths = {col: max(len(col), *(len(str(result[col])) for result in results)) for col in columns}
+    print('  '.join(col.ljust(widths[col]) for col in columns))
+    for result in results:
+        print('  '.join(str(result[col]).ljust(widths[col]) for col in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard against a mock Azure API')
+    parser.add_argument('--rows', type=int, default=5000, help='rows per mocked query result')
+    parser.add_argument('--page-size', type=int, default=5000, help='rows per mocked result page')
+    parser.add_argument('--latency', type=float, default=0.1, help='mock API latency in seconds')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of mock API calls answered with HTTP 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds of mocked HTTP 429 responses')
+    parser.add_argument('--reports', default=DEFAULT_REPORTS, help='comma separated reports to request')
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--result-cache', default='none', help='RESULT_CACHE_BACKEND used by the dashboard')
+    parser.add_argument('--trace-memory', action='store_true', help='also report the peak traced Python allocations per scenario')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    mock_process, mock_port = start_mock_api(args)
+    cache_dir = tempfile.TemporaryDirectory(prefix='bench-results-')
+    try:
+        dashboard, server, port = start_dashboard(mock_port, args)
+        base_url = f"http://127.0.0.1:{port}"
+        reports = [name.strip() for name in args.reports.split(',') if name.strip()]
+        results = []
+
+        reset_dashboard(dashboard, cache_dir.name)
+        results.append(run_scenario('index', base_url, ['/'], args.requests, args.concurrency, args.trace_memory))
+        results.append(run_scenario('api-cold', base_url, [f"/api/{name}" for name in reports], args.requests, args.concurrency, args.trace_memory))
+        reset_dashboard(dashboard, cache_dir.name)
+        results.append(run_scenario('page-cold', base_url, [f"/{name}" for name in reports], args.requests, args.concurrency, args.trace_memory))
+
+        reset_dashboard(dashboard, cache_dir.name)
+        started = time.perf_counter()
+        failed = dashboard.refresh_snapshot()
+        results.append({'scenario': 'snapshot-refresh', 'requests': 1, 'errors': len(failed), 'job_polls': '', 'throughput_rps': '',
+                        'p50_ms': '', 'p95_ms': '', 'p99_ms': '', 'max_ms': round((time.perf_counter() - started) * 1000, 1),
+                        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), 'traced_peak_mb': None})
+
+        results.append(run_scenario('api-warm', base_url, [f"/api/{name}" for name in reports], args.requests, args.concurrency, args.trace_memory))
+        results.append(run_scenario('page-warm', base_url, [f"/{name}" for name in reports], args.requests, args.concurrency, args.trace_memory))
+        results.append(run_scenario('data-api-warm', base_url, [f"/api/reports/{name}?limit=50&sort=cost&order=desc" for name in reports],
+                                    args.requests, args.concurrency, args.trace_memory))
+        server.shutdown()
+    finally:
+        mock_process.terminate()
+        mock_process.wait()
+        cache_dir.cleanup()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
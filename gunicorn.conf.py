@@ -0,0 +1,4 @@
+# Start the snapshot warmer in every worker once it has loaded the app, never in the master (which may preload the app)
+def post_worker_init(worker):
+    from app import ensure_snapshot_warmer
+    ensure_snapshot_warmer()
@@ -0,0 +1,16 @@
+# Shared setup of the tests: app.py reads its configuration when it is imported, so point it at throwaway state first
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_DIR = tempfile.mkdtemp(prefix='costs-tests-')
+
+os.environ.setdefault('SCOPE', 'providers/Microsoft.Billing/billingAccounts/test')
+os.environ.setdefault('ENABLE_SNAPSHOT_WARMER', 'false')
+os.environ.setdefault('RESULT_CACHE_BACKEND', 'none')
+os.environ.setdefault('SNAPSHOT_PATH', os.path.join(STATE_DIR, 'snapshot.pickle'))
+os.environ.setdefault('SNAPSHOT_LOCK_PATH', os.path.join(STATE_DIR, 'snapshot.lock'))
+os.environ.setdefault('QUERY_BODY_PATH', os.path.join(ROOT, 'body'))
+os.environ.setdefault('QUERY_SPEC_PATH', os.path.join(ROOT, 'queries.json'))
+sys.path.insert(0, ROOT)
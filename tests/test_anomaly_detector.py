@@ -0,0 +1,81 @@
+from datetime import date, timedelta
+
+import pandas as pd
+import pytest
+
+import app
+
+
+# Function to build a daily-resource-groups result from {group: [cost per day]} starting at `start`
+def daily_result(start, costs):
+    rows = [(cost, app.date_to_int(start + timedelta(days=offset)), group, 'USD')
+            for group, series in costs.items() for offset, cost in enumerate(series)]
+    return {'frame': pd.DataFrame(rows, columns=['PreTaxCost', 'UsageDate', 'ResourceGroup', 'Currency']), 'truncated': False}
+
+
+# Function to return the (group, date) pairs of the anomalies of a detector state
+def flagged(state):
+    return sorted((group, timestamp.date()) for group, timestamp in zip(state['anomalies']['group'], state['anomalies']['date']))
+
+
+@pytest.fixture
+def detector():
+    return app.AnomalyDetector(window=7, threshold=3.5, min_increase=10, history_days=120, restatement_days=3)
+
+
+def test_flags_a_spike_above_the_trailing_window(detector):
+    start = date(2026, 3, 1)
+    state = detector.update('daily-resource-groups', daily_result(start, {
+        'rg-web': [100, 102, 98, 101, 99, 100, 103, 97, 100, 400],
+        'rg-data': [50] * 10
+    }))
+
+    assert flagged(state) == [('rg-web', start + timedelta(days=9))]
+    assert state['scored_through'] == pd.Timestamp(start + timedelta(days=9))
+    assert state['currency'] == 'USD'
+
+
+def test_new_days_are_merged_and_scored_incrementally(detector):
+    start = date(2026, 3, 1)
+    detector.update('daily-resource-groups', daily_result(start, {'rg-web': [100] * 8 + [400] + [100] * 3}))
+
+    # The next refresh only returns the last days, the spike found earlier is outside its restatement window
+    state = detector.update('daily-resource-groups', daily_result(start + timedelta(days=10), {'rg-web': [100, 100, 100, 500]}))
+
+    assert list(state['history'].columns) == list(pd.date_range(start, start + timedelta(days=13)))
+    assert flagged(state) == [('rg-web', start + timedelta(days=8)), ('rg-web', start + timedelta(days=13))]
+
+
+def test_restated_days_are_scored_again(detector):
+    start = date(2026, 3, 1)
+    state = detector.update('daily-resource-groups', daily_result(start, {'rg-web': [100] * 9 + [400]}))
+    assert flagged(state) == [('rg-web', start + timedelta(days=9))]
+
+    # Azure restates the spike day, which is inside the restatement window of the last scored day
+    state = detector.update('daily-resource-groups', daily_result(start + timedelta(days=8), {'rg-web': [100, 100, 100]}))
+
+    assert flagged(state) == []
+    assert state['scored_through'] == pd.Timestamp(start + timedelta(days=10))
+
+
+def test_history_continues_across_the_month_rollover(detector):
+    # Month to date reports start again on the first day of the month, the history keeps the previous month
+    detector.update('daily-resource-groups', daily_result(date(2026, 9, 20), {'rg-web': [100] * 11, 'rg-data': [20] * 11}))
+    state = detector.update('daily-resource-groups', daily_result(date(2026, 10, 1), {'rg-web': [100, 450], 'rg-ml': [30, 30]}))
+
+    assert list(state['history'].columns) == list(pd.date_range(date(2026, 9, 20), date(2026, 10, 2)))
+    assert set(state['history'].index) == {'rg-web', 'rg-data', 'rg-ml'}
+    # Groups missing from the new month keep their history, the new one has no costs before it appeared
+    assert state['history'].loc['rg-data', pd.Timestamp(2026, 9, 30)] == 20
+    assert state['history'].loc['rg-ml', pd.Timestamp(2026, 9, 30)] == 0
+    assert ('rg-web', date(2026, 10, 2)) in flagged(state)
+
+
+def test_older_snapshot_versions_are_ignored(detector):
+    start = date(2026, 3, 1)
+    current = detector.update('daily-resource-groups', daily_result(start, {'rg-web': [100] * 10}), source_version=5)
+
+    stale = detector.update('daily-resource-groups', daily_result(start, {'rg-web': [100] * 9 + [900]}), source_version=4)
+
+    assert stale is current
+    assert flagged(stale) == []
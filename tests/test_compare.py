@@ -0,0 +1,31 @@
+import pandas as pd
+
+import app
+
+
+# Function to build the raw result frame of a last month or month to date report grouped by the team tag
+def team_result(rows):
+    return pd.DataFrame(rows, columns=['PreTaxCost', 'TagKey', 'TagValue', 'Currency'])
+
+
+def test_comparisons_keep_credits_blank_values_and_dashed_names():
+    current = app.clean_report_dataframe(team_result([
+        [100.0, 'team', 'web', 'USD'], [40.0, 'team', '', 'USD'], [10.0, 'team', None, 'USD'],
+        [-25.0, 'team', 'web', 'USD'], [30.0, 'team', 'rg-prod-01', 'USD']]), display_filters=False)
+    previous = app.clean_report_dataframe(team_result([
+        [50.0, 'team', 'web', 'USD'], [20.0, 'team', ' ', 'USD']]), display_filters=False)
+
+    comparison = app.compare_reports(current, previous).set_index('Owner:')
+
+    assert comparison.loc['web', ['current', 'previous', 'delta']].tolist() == [75.0, 50.0, 25.0]
+    assert comparison.loc[app.UNTAGGED_LABEL, ['current', 'previous', 'delta']].tolist() == [50.0, 20.0, 30.0]
+    assert comparison.loc['rg-prod-01', 'current'] == 30.0
+    # The compared values add up to the report totals
+    assert comparison['current'].sum() == current['PreTaxCost'].sum() == 155.0
+
+
+def test_report_pages_still_apply_the_display_filters():
+    df = app.clean_report_dataframe(team_result([[100.0, 'team', 'web', 'USD'], [30.0, 'team', 'rg-prod-01', 'USD'],
+                                                 [-25.0, 'team', 'web', 'USD']]))
+
+    assert df['PreTaxCost'].tolist() == [100.0]
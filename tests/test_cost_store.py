@@ -0,0 +1,120 @@
+from datetime import date, timedelta
+
+import pytest
+
+import app
+
+GROUPING = [{'type': 'Dimension', 'name': 'ResourceGroup'}]
+COLUMNS = [{'name': 'PreTaxCost', 'type': 'Number'}, {'name': 'UsageDate', 'type': 'Number'},
+           {'name': 'ResourceGroup', 'type': 'String'}, {'name': 'Currency', 'type': 'String'}]
+
+
+# Stand-in for the Cost Management query API: serves the daily costs in `costs` ({(date, group): cost}) for the
+# requested time period, two rows per page, and records every time period it was asked for
+class FakeQueryApi:
+    def __init__(self):
+        self.costs = {}
+        self.requested = []
+
+    def iter_result_pages(self, url, payload, max_rows=None):
+        start = date.fromisoformat(payload['timePeriod']['from'][:10])
+        end = date.fromisoformat(payload['timePeriod']['to'][:10])
+        self.requested.append((start, end))
+        rows = [[cost, app.date_to_int(day), group, 'USD'] for (day, group), cost in sorted(self.costs.items()) if start <= day <= end]
+        for offset in range(0, max(len(rows), 1), 2):
+            yield {'properties': {'columns': COLUMNS, 'rows': rows[offset:offset + 2], 'nextLink': None}}
+
+
+@pytest.fixture
+def api(monkeypatch):
+    fake = FakeQueryApi()
+    monkeypatch.setattr(app, 'iter_result_pages', fake.iter_result_pages)
+    return fake
+
+
+@pytest.fixture
+def store(tmp_path):
+    return app.CostStore(str(tmp_path / 'costs.sqlite'), restatement_days=3)
+
+
+# Function to build a query body summing the costs per resource group between two dates
+def period_payload(start, end, granularity='None'):
+    return {'type': 'Usage', 'timeframe': 'Custom',
+            'timePeriod': {'from': f"{start:%Y-%m-%d}T00:00:00Z", 'to': f"{end:%Y-%m-%d}T23:59:59Z"},
+            'dataset': {'granularity': granularity, 'aggregation': app.QUERY_AGGREGATION, 'grouping': GROUPING}}
+
+
+def totals(store, start, end):
+    return {row[1]: row[0] for row in store.query(period_payload(start, end))['properties']['rows']}
+
+
+def test_first_sync_backfills_from_the_floor_date(api, store):
+    today = date.today()
+    floor = today - timedelta(days=9)
+    for offset in range(10):
+        api.costs[(floor + timedelta(days=offset), 'rg-web')] = 10.0
+        api.costs[(floor + timedelta(days=offset), 'rg-data')] = 1.5
+
+    store.sync_dimension('scope', GROUPING, floor, today)
+
+    assert api.requested == [(floor, today)]
+    assert store.synced_range(GROUPING) == (floor, today)
+    assert totals(store, floor, today) == {'rg-web': 100.0, 'rg-data': 15.0}
+    assert store.covers(period_payload(floor, today))
+    assert not store.covers(period_payload(floor - timedelta(days=1), today))
+
+
+def test_later_syncs_only_refetch_and_replace_the_restatement_window(api, store):
+    today = date.today()
+    floor = today - timedelta(days=9)
+    for offset in range(9):
+        api.costs[(floor + timedelta(days=offset), 'rg-web')] = 10.0
+    store.sync_dimension('scope', GROUPING, floor, today - timedelta(days=1))
+
+    # Azure restates the last days and changes an old day that is outside the restatement window
+    api.costs[(floor, 'rg-web')] = 99.0
+    api.costs[(today - timedelta(days=2), 'rg-web')] = 25.0
+    api.costs[(today, 'rg-web')] = 10.0
+    api.requested.clear()
+    store.sync_dimension('scope', GROUPING, floor, today)
+
+    assert api.requested == [(today - timedelta(days=4), today)]
+    assert store.synced_range(GROUPING) == (floor, today)
+    # Restated days are replaced rather than added twice, days before the window keep their stored cost
+    assert totals(store, today - timedelta(days=4), today) == {'rg-web': 65.0}
+    assert totals(store, floor, floor) == {'rg-web': 10.0}
+    assert totals(store, floor, today) == {'rg-web': 115.0}
+
+
+def test_an_earlier_floor_date_backfills_again(api, store):
+    today = date.today()
+    store.sync_dimension('scope', GROUPING, today - timedelta(days=5), today)
+    api.requested.clear()
+
+    store.sync_dimension('scope', GROUPING, today - timedelta(days=20), today)
+
+    assert api.requested == [(today - timedelta(days=20), today)]
+    assert store.synced_range(GROUPING) == (today - timedelta(days=20), today)
+
+
+def test_backfills_are_split_into_one_year_queries(api, store):
+    today = date.today()
+    floor = today - timedelta(days=400)
+
+    store.sync_dimension('scope', GROUPING, floor, today)
+
+    assert api.requested == [(floor, floor + timedelta(days=364)), (floor + timedelta(days=365), today)]
+
+
+def test_daily_queries_are_aggregated_per_day(api, store):
+    today = date.today()
+    yesterday = today - timedelta(days=1)
+    api.costs[(yesterday, 'rg-web')] = 4.0
+    api.costs[(today, 'rg-web')] = 6.0
+    store.sync_dimension('scope', GROUPING, yesterday, today)
+
+    response = store.query(period_payload(yesterday, today, granularity='Daily'))
+
+    assert [col['name'] for col in response['properties']['columns']] == ['PreTaxCost', 'UsageDate', 'ResourceGroup', 'Currency']
+    assert response['properties']['rows'] == [[4.0, app.date_to_int(yesterday), 'rg-web', 'USD'],
+                                              [6.0, app.date_to_int(today), 'rg-web', 'USD']]
@@ -0,0 +1,47 @@
+import threading
+
+import app
+
+
+# Function to wait for a job and return its (response, error, status_code) result
+def finished(job):
+    assert job['done'].wait(5)
+    return job['result']
+
+
+def test_requests_for_a_running_query_share_its_job():
+    jobs = app.QueryJobs(max_workers=2, retention=60)
+    release = threading.Event()
+
+    def run():
+        release.wait(5)
+        return {'rows': []}, None, 200
+
+    first = jobs.submit('query/mtd-team', run)
+    second = jobs.submit('query/mtd-team', lambda: ({'rows': ['other']}, None, 200))
+    release.set()
+
+    assert second is first
+    assert finished(first) == ({'rows': []}, None, 200)
+
+
+def test_a_poll_gets_the_finished_job_it_polls():
+    jobs = app.QueryJobs(max_workers=2, retention=60)
+    job = jobs.submit('query/mtd-team', lambda: (None, 'throttled', 429))
+    finished(job)
+
+    polled = jobs.submit('query/mtd-team', lambda: ({'rows': []}, None, 200), job_id=job['id'])
+
+    assert polled is job
+    assert polled['status'] == 'failed'
+
+
+def test_a_poll_for_a_job_of_another_worker_starts_the_query_again():
+    jobs = app.QueryJobs(max_workers=2, retention=60)
+
+    polled = jobs.submit('query/mtd-team', lambda: ({'rows': []}, None, 200), job_id='job-of-another-worker')
+
+    assert polled['id'] != 'job-of-another-worker'
+    assert finished(polled) == ({'rows': []}, None, 200)
+    # Without a job ID, finished jobs are not reused and the query runs again
+    assert jobs.submit('query/mtd-team', lambda: ({'rows': []}, None, 200)) is not polled
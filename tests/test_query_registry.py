@@ -0,0 +1,28 @@
+import app
+
+
+def capture_requests(monkeypatch):
+    sent = []
+    monkeypatch.setattr(app, 'fetch_result', lambda url, payload, use_cache=True: sent.append((url, payload)) or {'properties': {}})
+    return sent
+
+
+def test_forecast_payload_is_sent_as_the_registry_builds_it(monkeypatch):
+    sent = capture_requests(monkeypatch)
+
+    app.run_query('forecast', query_scope='subscriptions/other')
+
+    url, payload = sent[0]
+    assert '/forecast?' in url
+    assert payload['timeframe'] == 'Custom'
+    assert payload == app.query_registry.payload('forecast')
+    assert payload['timePeriod']['from'] < payload['timePeriod']['to']
+
+
+def test_query_payloads_are_sent_unchanged(monkeypatch):
+    sent = capture_requests(monkeypatch)
+
+    app.run_query('mtd-team', query_scope='subscriptions/other')
+
+    assert sent[0][1] == app.query_registry.payload('mtd-team')
+    assert sent[0][1]['timeframe'] == 'MonthToDate'
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+import app
+
+
+# Freeze the date payload_window resolves relative timeframes against
+def freeze_today(monkeypatch, today):
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return today
+
+    monkeypatch.setattr(app, 'datetime', FrozenDatetime)
+
+
+def test_month_to_date_results_are_keyed_by_their_window(monkeypatch):
+    payload = app.query_registry.payload('mtd-team')
+    url = 'https://example/query'
+
+    freeze_today(monkeypatch, datetime(2026, 9, 30, 23, 50))
+    end_of_september = app.result_cache_key(url, payload)
+    freeze_today(monkeypatch, datetime(2026, 10, 1, 0, 10))
+    first_of_october = app.result_cache_key(url, payload)
+
+    assert end_of_september != first_of_october
+
+
+def test_compact_results_round_trip_through_the_sqlite_cache(tmp_path):
+    cache = app.SQLiteResultCache(str(tmp_path / 'results.sqlite'), max_entries=10)
+    result = app.result_frame_from_pages([{'properties': {
+        'columns': [{'name': 'PreTaxCost', 'type': 'Number'}, {'name': 'ResourceGroup', 'type': 'String'}],
+        'rows': [[1.5, 'rg-web'], [2.0, 'rg-data']], 'nextLink': None}}])
+
+    cache.set('key', result, 60)
+    cached = cache.get('key')
+
+    assert cached['columns'] == result['columns']
+    assert cached['frame'].equals(result['frame'])
+    assert cache.get('missing') is None
+    assert cache.status()['hits'] == 1 and cache.status()['misses'] == 1
@@ -0,0 +1,131 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+import requests
+
+import app
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+# Stand-in for the pooled Azure client: answers calls with the scripted responses (or raises scripted exceptions)
+class FakeAzureClient:
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        self.release = None
+
+    def request(self, method, url, payload=None):
+        self.calls += 1
+        if self.release:
+            self.release.wait(5)
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def scheduler():
+    # No backoff, so retries run immediately
+    return app.AzureRequestScheduler(max_concurrent=2, max_retries=2, backoff_base=0, backoff_max=0)
+
+
+def test_throttled_calls_are_retried_after_retry_after(monkeypatch, scheduler):
+    client = FakeAzureClient(FakeResponse(429, {'Retry-After': '0.2'}), FakeResponse(200))
+    monkeypatch.setattr(app, 'azure_client', client)
+
+    started = time.perf_counter()
+    response = scheduler.request('POST', 'https://example/query', {'a': 1})
+
+    assert response.status_code == 200
+    assert client.calls == 2
+    assert time.perf_counter() - started >= 0.2
+    assert scheduler.stats['throttled'] == 1
+    assert scheduler.stats['retries'] == 1
+
+
+def test_the_last_error_is_returned_once_retries_are_exhausted(monkeypatch, scheduler):
+    client = FakeAzureClient(FakeResponse(503))
+    monkeypatch.setattr(app, 'azure_client', client)
+
+    assert scheduler.request('POST', 'https://example/query').status_code == 503
+    assert client.calls == 3
+
+
+def test_client_errors_are_not_retried(monkeypatch, scheduler):
+    client = FakeAzureClient(FakeResponse(400))
+    monkeypatch.setattr(app, 'azure_client', client)
+
+    assert scheduler.request('POST', 'https://example/query').status_code == 400
+    assert client.calls == 1
+
+
+def test_connection_errors_are_retried_then_raised(monkeypatch, scheduler):
+    client = FakeAzureClient(requests.ConnectionError('reset'))
+    monkeypatch.setattr(app, 'azure_client', client)
+
+    with pytest.raises(requests.ConnectionError):
+        scheduler.request('POST', 'https://example/query')
+    assert client.calls == 3
+    assert scheduler.in_flight == {}
+
+
+def test_identical_concurrent_queries_share_one_call(monkeypatch, scheduler):
+    client = FakeAzureClient(FakeResponse(200))
+    client.release = threading.Event()
+    monkeypatch.setattr(app, 'azure_client', client)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(scheduler.request('POST', 'https://example/query', {'b': 1, 'a': 2})))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    # Wait until every thread is either making the call or waiting for it
+    deadline = time.time() + 5
+    while scheduler.stats['deduplicated'] < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    client.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert client.calls == 1
+    assert scheduler.stats['deduplicated'] == 2
+    assert len(results) == 3 and all(response is results[0] for response in results)
+
+    # Once answered, the same query goes upstream again
+    scheduler.request('POST', 'https://example/query', {'a': 2, 'b': 1})
+    assert client.calls == 2
+
+
+def test_http_date_retry_after_is_honoured():
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+
+    delay = app.AzureRequestScheduler._retry_after({'Retry-After': format_datetime(retry_at, usegmt=True)})
+
+    assert 28 <= delay <= 30
+    assert app.AzureRequestScheduler._retry_after({'Retry-After': 'soon'}) is None
+
+
+def test_calls_slow_down_as_the_remaining_quota_runs_low(monkeypatch):
+    scheduler = app.AzureRequestScheduler(max_concurrent=2, max_retries=2, backoff_base=0, backoff_max=0,
+                                          quota_low_watermark=4, quota_pause=0.4)
+    client = FakeAzureClient(FakeResponse(200, {'x-ms-ratelimit-microsoft.costmanagement-qpu-remaining': 'QueryResource=3;QueryTenant=90'}),
+                             FakeResponse(200, {'x-ms-ratelimit-microsoft.costmanagement-qpu-remaining': '50'}))
+    monkeypatch.setattr(app, 'azure_client', client)
+
+    scheduler.request('POST', 'https://example/query', {'a': 1})
+    started = time.perf_counter()
+    scheduler.request('POST', 'https://example/query', {'a': 2})
+
+    # 3 of 4 calls left pauses for a quarter of quota_pause, a healthy quota does not pause
+    assert time.perf_counter() - started >= 0.09
+    assert scheduler.stats['paced'] == 1
+    assert scheduler.blocked_until < time.time()